@@ -1,8 +1,15 @@
 import math
+import os
 import pickle
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import scipy.linalg as la
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
+
+from widefield.preprocess.movie_mask import remap_pixels
 
 basepath = '/suppscr/riekesheabrown/kpchamp/data/'
 datapath = basepath + 'decitranspose_detrend.h5'
@@ -21,6 +28,20 @@ def subspace_angle(Ain,Bin,cutoff=None):
     return math.acos(min(1,max(s[-1],-1)))
 
 
+# subspace_angle(A[:,0:k],B[:,0:k]) for every k = 1..cutoff. A^T B is formed once and each k only needs the
+# smallest singular value of its leading k x k block, so the cost no longer grows with the number of pixels per k.
+def subspace_angle_curve(Ain,Bin,cutoff=None):
+    if cutoff is None:
+        cutoff = min(Ain.shape[1],Bin.shape[1])
+    A = Ain[:,0:cutoff]
+    B = Bin[:,0:cutoff]
+    A = A/np.sqrt(np.sum(np.abs(A)**2,axis=0))
+    B = B/np.sqrt(np.sum(np.abs(B)**2,axis=0))
+    C = np.dot(A.T,B)
+    smin = np.array([la.svdvals(C[0:k,0:k],check_finite=False)[-1] for k in range(1,cutoff+1)])
+    return np.arccos(np.clip(smin,-1,1))
+
+
 def compare_components(Ain,Bin,cutoff=None):
     if cutoff is not None:
         A = Ain[:,0:cutoff]
@@ -33,23 +54,172 @@ def compare_components(Ain,Bin,cutoff=None):
     return np.abs(np.dot(A.T,B))
 
 
+# One-to-one matching of the components (rows and columns) of a similarity matrix S, e.g. from
+# compare_components, maximizing the total similarity. Similarities below threshold are dropped and the bipartite
+# graph of the rest splits into connected blocks, each matched separately with linear_sum_assignment, so large
+# sparse problems stay cheap. Returns the matched row and column indices and their similarities.
+def match_components(S, threshold=0.2):
+    n_rows, n_cols = S.shape
+    keep = S >= threshold
+    graph = sp.bmat([[None, sp.csr_matrix(keep)], [sp.csr_matrix(keep.T), None]])
+    n_blocks, labels = connected_components(graph, directed=False)
+    row_labels, col_labels = labels[:n_rows], labels[n_rows:]
+
+    rows, cols = [], []
+    for block in np.unique(row_labels):
+        r = np.flatnonzero(row_labels == block)
+        c = np.flatnonzero(col_labels == block)
+        if c.size == 0:
+            continue
+        sub = np.where(keep[np.ix_(r, c)], S[np.ix_(r, c)], 0.)
+        i, j = linear_sum_assignment(-sub)
+        matched = keep[r[i], c[j]]
+        rows.append(r[i][matched])
+        cols.append(c[j][matched])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+    order = np.argsort(rows)
+    return rows[order], cols[order], S[rows[order], cols[order]]
+
+
+# Follows components through a list of bases (e.g. the evecs of consecutive sessions) by matching each basis
+# to the next with match_components on compare_components(bases[s], bases[s+1], cutoff). Returns tracks, an
+# n_tracks x n_sessions array of the column of each track in each basis (-1 where it is not present), and
+# confidence, n_tracks x (n_sessions-1), the similarity of each link (nan where there is none). Components
+# that are not matched to the previous basis start new tracks.
+def track_components(bases, cutoff=None, threshold=0.2):
+    n_sessions = len(bases)
+    k0 = bases[0].shape[1] if cutoff is None else min(cutoff, bases[0].shape[1])
+    tracks = [[i] + [-1]*(n_sessions - 1) for i in range(k0)]
+    links = [[np.nan]*(n_sessions - 1) for i in range(k0)]
+    current = dict((i, i) for i in range(k0))  # column in the current basis -> track
+    for s in range(n_sessions - 1):
+        S = compare_components(bases[s], bases[s+1], cutoff)
+        rows, cols, sim = match_components(S, threshold)
+        following = {}
+        for r, c, v in zip(rows, cols, sim):
+            t = current[r]
+            tracks[t][s+1] = c
+            links[t][s] = v
+            following[c] = t
+        for c in range(S.shape[1]):
+            if c not in following:
+                following[c] = len(tracks)
+                tracks.append([-1]*(s + 1) + [c] + [-1]*(n_sessions - s - 2))
+                links.append([np.nan]*(n_sessions - 1))
+        current = following
+    return np.array(tracks, dtype=int), np.array(links).reshape((len(tracks), n_sessions - 1))
+
+
+def evecs_filename(dfrow):
+    return basepath + dfrow['mouseId'] + '/' + dfrow['date'] + '/evecs/evecs_twin%d_nsamples%d_tstart%d.pkl' % (dfrow['windowLength'],dfrow['sampleSize'],dfrow['startTime'])
+
+
 def get_component_comparison(dfrow1,dfrow2,cutoff=None):
-    fname1 = basepath + dfrow1['mouseId'] + '/' + dfrow1['date'] + '/evecs/evecs_twin%d_nsamples%d_tstart%d.pkl' % (dfrow1['windowLength'],dfrow1['sampleSize'],dfrow1['startTime'])
-    fname2 = basepath + dfrow2['mouseId'] + '/' + dfrow2['date']  + '/evecs/evecs_twin%d_nsamples%d_tstart%d.pkl' % (dfrow2['windowLength'],dfrow2['sampleSize'],dfrow2['startTime'])
-    A = pickle.load(open(fname1,'r'))
-    B = pickle.load(open(fname2,'r'))
+    A = pickle.load(open(evecs_filename(dfrow1),'r'))
+    B = pickle.load(open(evecs_filename(dfrow2),'r'))
     return compare_components(A,B,cutoff)
 
 
 def get_subspace_angles(dfrow1,dfrow2,cutoff):
-    fname1 = basepath + dfrow1['mouseId'] + '/' + dfrow1['date'] + '/evecs/evecs_twin%d_nsamples%d_tstart%d.pkl' % (dfrow1['windowLength'],dfrow1['sampleSize'],dfrow1['startTime'])
-    fname2 = basepath + dfrow2['mouseId'] + '/' + dfrow2['date'] + '/evecs/evecs_twin%d_nsamples%d_tstart%d.pkl' % (dfrow2['windowLength'],dfrow2['sampleSize'],dfrow2['startTime'])
-    A = pickle.load(open(fname1,'r'))
-    B = pickle.load(open(fname2,'r'))
-    angles = np.zeros((cutoff,))
-    for i in range(cutoff):
-        angles[i] = subspace_angle(A[:,0:i+1],B[:,0:i+1])
-    return angles
+    A = pickle.load(open(evecs_filename(dfrow1),'r'))
+    B = pickle.load(open(evecs_filename(dfrow2),'r'))
+    return subspace_angle_curve(A,B,cutoff)
+
+
+# Store of component bases (e.g. the evecs of many sessions or windows) for all-pairs comparisons. Each basis is
+# loaded once, truncated to its first cutoff columns, normalized and saved as a .npy file in directory, which
+# is then read back as a memmap; reopening the directory reuses the stored bases. Bases with different masks
+# are brought to n_common common pixels by passing add the session's (dest, src) pixel map from
+# movie_mask.common_pixel_map, which is applied with remap_pixels before the basis is stored.
+class ComponentStore:
+    def __init__(self, directory, cutoff, n_common=None):
+        self.directory = directory
+        self.cutoff = cutoff
+        self.n_common = n_common
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        keyfile = os.path.join(directory, 'keys.pkl')
+        self.keys = pickle.load(open(keyfile, 'rb')) if os.path.exists(keyfile) else []
+        self.bases = {}
+
+    def add(self, key, evecs, pixel_map=None):
+        if key in self.keys:
+            return self
+        A = evecs[:,0:self.cutoff]
+        if pixel_map is not None:
+            if self.n_common is None:
+                raise ValueError("a pixel_map needs the store's n_common")
+            # dropping pixels breaks the orthogonality of evecs; QR keeps the span of every prefix of columns
+            A = la.qr(remap_pixels(A, pixel_map, self.n_common), mode='economic')[0]
+        A = A/np.sqrt(np.sum(np.abs(A)**2,axis=0))
+        np.save(self.basis_filename(len(self.keys)), A)
+        self.keys.append(key)
+        pickle.dump(self.keys, open(os.path.join(self.directory, 'keys.pkl'), 'wb'))
+        return self
+
+    # adds the evecs pickled for a row of the analysis dataframe, keyed by its file name
+    def add_dfrow(self, dfrow):
+        fname = evecs_filename(dfrow)
+        if fname not in self.keys:
+            self.add(fname, pickle.load(open(fname, 'rb')))
+        return fname
+
+    def basis_filename(self, i):
+        return os.path.join(self.directory, 'basis%d.npy' % i)
+
+    def basis(self, key):
+        if key not in self.bases:
+            self.bases[key] = np.load(self.basis_filename(self.keys.index(key)), mmap_mode='r')
+        return self.bases[key]
+
+    # N x N matrix of similarities between all stored bases: 'angle' is the largest principal angle
+    # (subspace_angle), 'overlap' the mean squared cosine of the principal angles, ||A^T B||_F^2/cutoff. Blocks
+    # of block_size x block_size bases are computed in a pool of n_threads threads, each with one product of
+    # the stacked bases. The result is saved in directory and reused while the stored keys are unchanged.
+    def similarity_matrix(self, metric='angle', n_threads=4, block_size=8):
+        if metric not in ('angle', 'overlap'):
+            raise ValueError("metric=%r must be 'angle' or 'overlap'" % metric)
+        fname = os.path.join(self.directory, 'similarity_%s.pkl' % metric)
+        if os.path.exists(fname):
+            saved = pickle.load(open(fname, 'rb'))
+            if saved['keys'] == self.keys:
+                return saved['matrix']
+
+        n = len(self.keys)
+        S = np.zeros((n, n))
+        blocks = [range(i, min(i + block_size, n)) for i in range(0, n, block_size)]
+
+        def compare_block(ij):
+            I, J = blocks[ij[0]], blocks[ij[1]]
+            A = np.hstack([self.basis(self.keys[i]) for i in I])
+            B = np.hstack([self.basis(self.keys[j]) for j in J])
+            C = np.dot(A.T, B)
+            a = np.cumsum([0] + [self.basis(self.keys[i]).shape[1] for i in I])
+            b = np.cumsum([0] + [self.basis(self.keys[j]).shape[1] for j in J])
+            for ii, i in enumerate(I):
+                for jj, j in enumerate(J):
+                    Cij = C[a[ii]:a[ii+1], b[jj]:b[jj+1]]
+                    if metric == 'angle':
+                        S[i, j] = math.acos(min(1, max(la.svdvals(Cij)[-1], -1)))
+                    else:
+                        S[i, j] = np.sum(Cij**2)/min(Cij.shape)
+                    S[j, i] = S[i, j]
+
+        pairs = [(bi, bj) for bi in range(len(blocks)) for bj in range(bi, len(blocks))]
+        if n_threads > 1:
+            pool = ThreadPool(n_threads)
+            try:
+                pool.map(compare_block, pairs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for ij in pairs:
+                compare_block(ij)
+
+        pickle.dump({'keys': list(self.keys), 'matrix': S}, open(fname, 'wb'))
+        return S
 
 
 def get_cutoff(data,type):
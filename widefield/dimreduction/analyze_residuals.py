@@ -1,7 +1,7 @@
 import numpy as np
-from scipy.stats import skew, kurtosis
 
 from widefield.dimreduction.pca import ppca_model
+from widefield.tools.chunk_tools import iter_chunks, chunk_size as default_chunk_size
 
 
 def get_residual_and_moments(n_components, X, bias=True):
@@ -14,28 +14,67 @@ def get_residual_and_moments(n_components, X, bias=True):
     # f.close()
 
     ppca = ppca_model(X, n_components=n_components)
-    print "number of components is %d" % ppca.components.shape[1]
+    print("number of components is %d" % ppca.components.shape[1])
     Xnew = ppca.reconstruct(X)
     R = X - Xnew
     del X
     del Xnew
 
-    print "getting moments"
-    moments = np.zeros((R.shape[1],4))
-    for i in range(R.shape[1]):
-        moments[i,0] = np.mean(R[:,i])
-        moments[i,1] = np.std(R[:,i])**2
-        moments[i,2] = skew(R[:,i], bias=bias)
-        moments[i,3] = kurtosis(R[:,i], fisher=True, bias=bias)
-
-    return R,moments
+    print("getting moments")
+    return R,get_moments(R, bias)
 
 
 def get_moments(R, bias=True):
-    moments = np.zeros((R.shape[1],4))
-    for i in range(R.shape[1]):
-        moments[i,0] = np.mean(R[:,i])
-        moments[i,1] = np.std(R[:,i])**2
-        moments[i,2] = skew(R[:,i], bias=bias)
-        moments[i,3] = kurtosis(R[:,i], fisher=True, bias=bias)
-    return moments
\ No newline at end of file
+    return moment_maps(column_moments(R), bias)
+
+
+# Per-pixel mean, variance, skewness and (Fisher) kurtosis of the PPCA residual X - ppca.reconstruct(X), as
+# returned by get_residual_and_moments, without forming the residual: X (array, memmap or PyTables array) is
+# streamed in chunks and the moments of each chunk's residual are merged. The PPCA model is fit from streamed
+# moments unless ppca is given. Returns pixels x 4, e.g. for unmask_to_movie.
+def get_residual_moment_maps(n_components, X, bias=True, ppca=None, chunk_size=default_chunk_size):
+    if ppca is None:
+        ppca = ppca_model(X, n_components=n_components, fitWith='covariance', chunk_size=chunk_size)
+    moments = None
+    for chunk in iter_chunks(X, chunk_size):
+        R = np.asarray(chunk, dtype=np.float64) - ppca.reconstruct(chunk, n_components)
+        moments = column_moments(R) if moments is None else merge_column_moments(moments, column_moments(R))
+    return moment_maps(moments, bias)
+
+
+# (n, mean, M2, M3, M4) of each column of R, with Mk the sums of the k-th powers of the deviations from the mean
+def column_moments(R):
+    R = np.asarray(R, dtype=np.float64)
+    mean = np.mean(R, axis=0)
+    D = R - mean
+    D2 = D**2
+    return R.shape[0], mean, np.sum(D2, axis=0), np.sum(D2*D, axis=0), np.sum(D2**2, axis=0)
+
+
+# column moments of the union of two sets of rows (Pebay 2008)
+def merge_column_moments(a, b):
+    na, mean_a, M2a, M3a, M4a = a
+    nb, mean_b, M2b, M3b, M4b = b
+    if na == 0 or nb == 0:
+        return a if nb == 0 else b
+    n = na + nb
+    d = mean_b - mean_a
+    mean = mean_a + d*nb/float(n)
+    M2 = M2a + M2b + d**2*na*nb/float(n)
+    M3 = M3a + M3b + d**3*na*nb*(na - nb)/float(n)**2 + 3.*d*(na*M2b - nb*M2a)/float(n)
+    M4 = M4a + M4b + d**4*na*nb*(na**2 - na*nb + nb**2)/float(n)**3 + \
+        6.*d**2*(na**2*M2b + nb**2*M2a)/float(n)**2 + 4.*d*(na*M3b - nb*M3a)/float(n)
+    return n, mean, M2, M3, M4
+
+
+# pixels x 4 array of mean, variance, skewness and Fisher kurtosis as scipy.stats skew and kurtosis compute them
+def moment_maps(moments, bias=True):
+    n, mean, M2, M3, M4 = moments
+    n = float(n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g1 = np.sqrt(n)*M3/M2**1.5
+        g2 = n*M4/M2**2 - 3.
+        if not bias:
+            g1 = g1*np.sqrt(n*(n - 1.))/(n - 2.)
+            g2 = ((n + 1.)*g2 + 6.)*(n - 1.)/((n - 2.)*(n - 3.))
+    return np.column_stack((mean, M2/n, g1, g2))
@@ -1,17 +1,34 @@
 import numpy as np
 import scipy.linalg as la
-from sklearn.decomposition import FactorAnalysis
 import warnings
-from memory_profiler import profile
 
+from widefield.dimreduction.lowrank_gaussian import lowrank_log_likelihoods
+from widefield.dimreduction.pca import randomized_svd, working_dtype, subtract_mean
+from widefield.tools.chunk_tools import iter_chunks, chunk_size as default_chunk_size
 
+
+# Factor analysis X = W^T z + noise with diagonal noise covariance psi. fit_type='sklearn' uses sklearn's
+# FactorAnalysis; otherwise my_fit runs the same SVD-based EM natively, with the settings below:
+#   svd_method: 'randomized' (n_components + 10 random directions refined by iterated_power power iterations, seed)
+#               or 'lapack' (full SVD)
+#   max_iter, tol: iterations stop once the log likelihood increases by less than tol, or by less than its
+#               rounding level (10 eps of the working dtype times |ll|) if that is larger, as for float32 data
+#   noise_variance_init: initial psi (default ones)
+#   components_init: loadings (k' x n_features, e.g. of a fit with fewer factors) that warm-start the randomized
+#               range finder, padded with random directions for the new factors
+#   dtype: dtype of the centered data and components, e.g. float32; variances and likelihoods are float64
+#   chunk_size: rows per chunk for the mean and variance of Xin
+#   profile: run my_fit under memory_profiler
 class fa_model:
-    def __init__(self, Xin, n_components=None, fit_type='sklearn'):
+    def __init__(self, Xin, n_components=None, fit_type='sklearn', svd_method='randomized', max_iter=1000, tol=1e-2,
+                 noise_variance_init=None, components_init=None, iterated_power=3, seed=None, dtype=None,
+                 chunk_size=default_chunk_size, profile=False):
         self.n_samples, self.n_features = Xin.shape
+        self.dtype = working_dtype(Xin, dtype)
 
         # Center data
-        self.mean = np.mean(Xin, axis=0)
-        X = Xin - self.mean
+        self.mean, self.var = column_mean_var(Xin, chunk_size)
+        X = subtract_mean(Xin, self.mean, self.dtype)
 
         if n_components is None:
             self.n_components = min(self.n_features,self.n_samples)
@@ -20,70 +37,83 @@ class fa_model:
         else:
             self.n_components = n_components
 
+        self.svd_method = svd_method
+        self.max_iter = max_iter
+        self.tol = tol
+        self.noise_variance_init = noise_variance_init
+        self.components_init = components_init
+        self.iterated_power = iterated_power
+        self.seed = seed
+
         self.components = None
         self.variance = None
         self.ll = None
         self.n_iters = None
 
-        fa = FactorAnalysis(n_components=n_components)
         if fit_type=='sklearn':
+            from sklearn.decomposition import FactorAnalysis
+            fa = FactorAnalysis(n_components=n_components)
             fa.fit(X)
             self.components = fa.components_
             self.variance = fa.noise_variance_
             self.ll = fa.loglike_
             self.n_iters = fa.n_iter_
+        elif profile:
+            from memory_profiler import profile as memory_profile
+            memory_profile(self.my_fit)(X)
         else:
             self.my_fit(X)
 
-    @profile
     def my_fit(self, X):
         n_samples, n_features = X.shape
         n_components = self.n_components
-        if n_components is None:
-            n_components = n_features
 
         # some constant terms
         nsqrt = np.sqrt(n_samples)
         llconst = n_features * np.log(2. * np.pi) + n_components
-        var = np.var(X, axis=0)
+        var = self.var
 
         if self.noise_variance_init is None:
-            psi = np.ones(n_features, dtype=X.dtype)
+            psi = np.ones(n_features)
         else:
             if len(self.noise_variance_init) != n_features:
                 raise ValueError("noise_variance_init dimension does not "
                                  "with number of features : %d != %d" %
                                  (len(self.noise_variance_init), n_features))
-            psi = np.array(self.noise_variance_init)
+            psi = np.array(self.noise_variance_init, dtype=np.float64)
 
         loglike = []
         old_ll = -np.inf
         SMALL = 1e-12
 
         # we'll modify svd outputs to return unexplained variance
-        # to allow for unified computation of loglikelihood
+        # to allow for unified computation of loglikelihood. The squared norm of the scaled data is
+        # sum(var/psi), so only the leading singular values are needed.
         if self.svd_method == 'lapack':
             def my_svd(X):
                 _, s, V = la.svd(X, full_matrices=False)
-                return (s[:n_components], V[:n_components],
-                        np.dot(s[n_components:],s[n_components:]))
-        # elif self.svd_method == 'randomized':
-        #     random_state = check_random_state(self.random_state)
-        #
-        #     def my_svd(X):
-        #         _, s, V = randomized_svd(X, n_components,
-        #                                  random_state=random_state,
-        #                                  n_iter=self.iterated_power)
-        #         return s, V, squared_norm(X) - squared_norm(s)
+                return s[:n_components], V[:n_components]
+        elif self.svd_method == 'randomized':
+            # each iteration starts the range finder from the previous right singular vectors
+            init = [None]
+            if self.components_init is not None:
+                init[0] = (np.asarray(self.components_init, dtype=np.float64)/(np.sqrt(psi) + SMALL)).T
+
+            def my_svd(X):
+                _, s, V = randomized_svd(X, n_components, n_power_iter=self.iterated_power, seed=self.seed,
+                                         init=init[0])
+                init[0] = V.T
+                return s, V
         else:
             raise ValueError('SVD method %s is not supported. Please consider'
                              ' the documentation' % self.svd_method)
 
-        for i in xrange(self.max_iter):
+        for i in range(self.max_iter):
             # SMALL helps numerics
             sqrt_psi = np.sqrt(psi) + SMALL
-            s, V, unexp_var = my_svd(X / (sqrt_psi * nsqrt))
-            s **= 2
+            s, V = my_svd(X / (sqrt_psi * nsqrt).astype(X.dtype))
+            s = s.astype(np.float64)**2
+            unexp_var = np.sum(var / sqrt_psi**2) - np.sum(s)
             # Use 'maximum' here to avoid sqrt problems.
             W = np.sqrt(np.maximum(s - 1., 0.))[:, np.newaxis] * V
             del V
@@ -94,18 +124,41 @@ class fa_model:
             ll += unexp_var + np.sum(np.log(psi))
             ll *= -n_samples / 2.
             loglike.append(ll)
-            if (ll - old_ll) < self.tol:
+            if (ll - old_ll) < max(self.tol, 10.*np.finfo(X.dtype).eps*abs(ll)):
                 break
             old_ll = ll
 
-            psi = np.maximum(var - np.sum(W ** 2, axis=0), SMALL)
+            psi = np.maximum(var - np.sum(W.astype(np.float64) ** 2, axis=0), SMALL)
         else:
             warnings.warn('FactorAnalysis did not converge.' +
                           ' You might want' +
                           ' to increase the number of iterations.')
 
-        self.components = W
+        self.components = W.astype(self.dtype, copy=False)
         self.variance = psi
-        self.ll = loglike
+        self.ll = np.array(loglike)
         self.n_iters = i + 1
         return self
+
+    # log likelihood of each row of Xin (array, memmap, PyTables array or iterable of row chunks) under
+    # N(mean, W^T W + diag(psi)), without forming the covariance (see lowrank_gaussian)
+    def score_samples(self, Xin, chunk_size=default_chunk_size):
+        return lowrank_log_likelihoods(Xin, self.mean, self.components, self.variance, chunk_size)
+
+    # average log likelihood of the rows of Xin, as FactorAnalysis.score
+    def score(self, Xin, chunk_size=default_chunk_size):
+        return np.mean(self.score_samples(Xin, chunk_size))
+
+
+# mean and (biased) variance of the columns of X, accumulated in float64 one chunk of rows at a time
+def column_mean_var(X, chunk_size=default_chunk_size):
+    n_samples = X.shape[0]
+    total = np.zeros(X.shape[1])
+    for chunk in iter_chunks(X, chunk_size):
+        total += np.sum(chunk, axis=0, dtype=np.float64)
+    mean = total/n_samples
+    sq = np.zeros(X.shape[1])
+    for chunk in iter_chunks(X, chunk_size):
+        D = np.asarray(chunk, dtype=np.float64) - mean
+        sq += np.einsum('ij,ij->j', D, D)
+    return mean, sq/n_samples
@@ -0,0 +1,41 @@
+import numpy as np
+import scipy.linalg as la
+
+from widefield.tools.chunk_tools import iter_chunks, chunk_size as default_chunk_size
+
+# Gaussian log likelihoods under covariances C = W^T W + diag(psi) with W n_factors x n_features (factor
+# analysis; psi a vector) or PPCA (W = components.T, psi = s2 a scalar). With M = I + W diag(1/psi) W^T = L L^T,
+# the matrix determinant lemma gives log|C| = sum(log psi) + log|M| and the Woodbury identity
+# x^T C^-1 x = x^T diag(1/psi) x - |L^-1 W diag(1/psi) x|^2, so scoring N samples costs O(N*d*k + k^3) and no
+# d x d matrix is formed.
+
+
+# W diag(1/psi), the Cholesky factor L of M and log|C|
+def lowrank_factor(W, psi):
+    W = np.asarray(W, dtype=np.float64)
+    psi = np.broadcast_to(np.asarray(psi, dtype=np.float64), (W.shape[1],))
+    Wpsi = W/psi
+    L = la.cholesky(np.identity(W.shape[0]) + np.dot(Wpsi, W.T), lower=True)
+    logdet = np.sum(np.log(psi)) + 2.*np.sum(np.log(np.diag(L)))
+    return Wpsi, L, logdet
+
+
+# Log likelihood of each row of X, which may be an array, memmap, PyTables array or an iterable of row chunks
+def lowrank_log_likelihoods(X, mean, W, psi, chunk_size=default_chunk_size):
+    Wpsi, L, logdet = lowrank_factor(W, psi)
+    psi = np.broadcast_to(np.asarray(psi, dtype=np.float64), (Wpsi.shape[1],))
+    const = -0.5*(psi.size*np.log(2.*np.pi) + logdet)
+    chunks = iter_chunks(X, chunk_size) if hasattr(X, 'shape') else X
+    ll = []
+    for chunk in chunks:
+        Xc = np.asarray(chunk, dtype=np.float64) - mean
+        Z = la.solve_triangular(L, np.dot(Wpsi, Xc.T), lower=True)
+        quad = np.sum(Xc**2/psi, axis=1) - np.sum(Z**2, axis=0)
+        ll.append(const - 0.5*quad)
+    return np.concatenate(ll) if ll else np.zeros(0)
+
+
+# total log likelihood of the rows of X and the number of rows
+def lowrank_log_likelihood(X, mean, W, psi, chunk_size=default_chunk_size):
+    ll = lowrank_log_likelihoods(X, mean, W, psi, chunk_size)
+    return np.sum(ll), ll.size
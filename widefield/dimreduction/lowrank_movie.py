@@ -0,0 +1,117 @@
+from __future__ import division
+
+import numpy as np
+import tables as tb
+
+from widefield.dimreduction.pca import streaming_moments, streaming_mean, covariance_eig, subtract_mean
+from widefield.tools.chunk_tools import chunk_size as default_chunk_size
+
+
+# Compressed storage of a frames x pixels movie X (array, memmap or PyTables array such as the data of
+# data_detrend_mask.h5) as mean + temporal*diag(singular_values)*spatial, with spatial the leading
+# n_components principal directions (n_components x pixels) and temporal the unit-norm temporal components
+# (frames x n_components). basis (pixels x n_components, orthonormal columns, e.g. pca_model evecs) skips the
+# fit; otherwise it is fit from the streamed covariance of X. The norms of each centered frame and of its
+# residual are saved too. X is read in two passes of chunk_size frames.
+def save_lowrank_movie(filename, X, n_components=None, basis=None, chunk_size=default_chunk_size,
+                       dtype=np.float32, complevel=5):
+    n_frames, n_pixels = X.shape
+    if basis is None:
+        if n_components is None:
+            raise ValueError("n_components must be specified if no basis is given")
+        n, mean, scatter = streaming_moments(X, chunk_size)
+        evals, basis = covariance_eig(scatter/n, n_components)
+    else:
+        mean = streaming_mean(X, chunk_size)
+    basis = np.asarray(basis, dtype=np.float64)
+    n_components = basis.shape[1]
+
+    filters = tb.Filters(complevel=complevel, complib='blosc')
+    atom = tb.Atom.from_dtype(np.dtype(dtype))
+    f = tb.open_file(filename, 'w')
+    try:
+        f.create_array(f.root, 'spatial', np.ascontiguousarray(basis.T, dtype=dtype))
+        f.create_array(f.root, 'mean', mean)
+        temporal = f.create_carray(f.root, 'temporal', atom, (n_frames, n_components), filters=filters,
+                                   chunkshape=(min(chunk_size, n_frames), n_components))
+
+        frame_norms = np.zeros(n_frames)
+        residual_norms = np.zeros(n_frames)
+        sq_sv = np.zeros(n_components)
+        for start in range(0, n_frames, chunk_size):
+            stop = min(start + chunk_size, n_frames)
+            Xc = subtract_mean(X[start:stop], mean, np.float64)
+            Z = np.dot(Xc, basis)
+            R = Xc - np.dot(Z, basis.T)
+            frame_norms[start:stop] = np.sqrt(np.einsum('ij,ij->i', Xc, Xc))
+            residual_norms[start:stop] = np.sqrt(np.einsum('ij,ij->i', R, R))
+            sq_sv += np.sum(Z**2, axis=0)
+            temporal[start:stop] = Z
+
+        # scale the temporal components to unit norm
+        singular_values = np.sqrt(sq_sv)
+        scale = 1./np.maximum(singular_values, np.finfo(np.float64).tiny)
+        for start in range(0, n_frames, chunk_size):
+            stop = min(start + chunk_size, n_frames)
+            temporal[start:stop] = temporal[start:stop]*scale
+
+        f.create_array(f.root, 'singular_values', singular_values)
+        f.create_array(f.root, 'frame_norms', frame_norms)
+        f.create_array(f.root, 'residual_norms', residual_norms)
+    finally:
+        f.close()
+
+
+# Reader for files written by save_lowrank_movie. Indexing reconstructs frames on demand, e.g. movie[t0:t1]
+# or movie[t0:t1, pixels], reading only the temporal components of those frames; len, shape, ndim and dtype
+# behave as for the original movie, so it can be passed wherever a frames x pixels memmap or PyTables array is
+# streamed. Analyses that work in component space (e.g. regressions) can use temporal_components instead.
+class LowRankMovie:
+    def __init__(self, filename):
+        self.file = tb.open_file(filename, 'r')
+        self.spatial = self.file.root.spatial[:]
+        self.singular_values = self.file.root.singular_values[:]
+        self.mean = self.file.root.mean[:]
+        self.temporal = self.file.root.temporal
+        self.n_components = self.spatial.shape[0]
+        self.shape = (int(self.temporal.shape[0]), int(self.spatial.shape[1]))
+        self.ndim = 2
+        self.dtype = self.spatial.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            frames, pixels = key
+        else:
+            frames, pixels = key, slice(None)
+        U = self.temporal[frames]
+        return np.dot(U*self.singular_values.astype(self.dtype), self.spatial[:, pixels]) + \
+            self.mean[pixels].astype(self.dtype)
+
+    # temporal components of frames start:stop, scaled by the singular values unless scaled=False
+    def temporal_components(self, start=0, stop=None, scaled=True):
+        U = self.temporal[start:stop]
+        if scaled:
+            return U*self.singular_values.astype(U.dtype)
+        return U
+
+    # per-frame norms of the centered data and of the residual not captured by the components, and the overall
+    # fraction of variance explained
+    def residual_summary(self):
+        frame_norms = self.file.root.frame_norms[:]
+        residual_norms = self.file.root.residual_norms[:]
+        total = np.sum(frame_norms**2)
+        return {'frame_norms': frame_norms, 'residual_norms': residual_norms,
+                'variance_explained': 1. - np.sum(residual_norms**2)/total if total > 0 else 1.,
+                'max_residual_norm': np.max(residual_norms) if residual_norms.size else 0.}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
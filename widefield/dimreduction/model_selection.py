@@ -1,19 +1,107 @@
 from __future__ import division
 
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+
 import numpy as np
 
+from widefield.dimreduction.fa import fa_model
 from widefield.dimreduction.optimal_svht_coef import optimal_svht_coef
-from widefield.dimreduction.pca import ppca_model
+from widefield.dimreduction.pca import ppca_model, streaming_moments, accumulate_moments, merge_moments, \
+    downdate_moments
+from widefield.tools.chunk_tools import gather_rows, chunk_size as default_chunk_size
 
 
-def pca_select(X, ps, n_folds=4):
+# n_jobs > 1 runs the full-data fit and the cross-validation folds in a process pool. Workers read X as a
+# memmap of its own file if it is one, otherwise of a temporary copy, rather than receiving a pickled copy;
+# blas_threads limits the BLAS threads of each worker
+# (e.g. n_jobs*blas_threads = number of cores). The results are the same as with n_jobs=1.
+# method='covariance' instead makes a single pass over X (which may be a memmap or PyTables array) to get the
+# moments of every fold; each training set covariance is then the total minus the held-out fold, so the fits
+# are d x d eigendecompositions rather than SVDs of the data.
+def pca_select(X, ps, n_folds=4, n_jobs=1, blas_threads=None, method='SVD', chunk_size=default_chunk_size):
     n_samples, n_features = X.shape
-    testSize = n_samples/n_folds
+    testSize = n_samples//n_folds
+
+    if method == 'covariance':
+        fold_moments = [streaming_moments(X, chunk_size, i*testSize, (i+1)*testSize) for i in range(n_folds)]
+        return select_from_moments(fold_moments, ps)
+    elif method != 'SVD':
+        raise ValueError("method=%r must be 'SVD' or 'covariance'" % method)
 
     folds=np.reshape(np.arange(n_samples),(n_folds,testSize))
 
+    # the full-data fit followed by one (trainSet, testSet) job per fold
+    jobs = [None]
+    for i_folds in np.arange(n_folds):
+        testSet = folds[i_folds,:]
+        trainSet = folds[np.arange(n_folds)[~(np.arange(n_folds) == i_folds)],:].flatten()
+        jobs.append((trainSet, testSet))
+
+    if n_jobs == 1:
+        results = [_select_job(X, job, ps) for job in jobs]
+    else:
+        results = _run_shared(X, _select_job_shared, jobs, ps, n_jobs, blas_threads)
+    return _select_summary(results[0], np.array(results[1:]), ps)
+
+
+# pca_select at several nested sample sizes with one pass over the data. A single random permutation of frames
+# (default all rows of X) is drawn and sample i of the permutation goes to fold i % n_folds, so the folds of
+# every prefix are nested and their moments are accumulated incrementally. Yields (n_samples, data, evecs)
+# for each of the sorted sample_sizes (multiples of n_folds), with data as returned by pca_select plus the
+# frames used in data['perm']. X can be a PyTables array, in which case only the sampled frames are read, in
+# storage order for each sample size.
+def pca_select_sweep(X, sample_sizes, ps, n_folds=4, frames=None, seed=None, chunk_size=default_chunk_size):
+    sample_sizes = np.sort(sample_sizes)
+    if np.any(sample_sizes % n_folds != 0):
+        raise ValueError("sample sizes %r must be multiples of n_folds=%d" % (sample_sizes, n_folds))
+    if frames is None:
+        frames = np.arange(X.shape[0])
+    rng = np.random.RandomState(seed)
+    perm = rng.choice(frames, sample_sizes[-1], replace=False)
+
+    fold_moments = [None]*n_folds
+    n_read = 0
+    for n_samples in sample_sizes:
+        # the new frames are read in storage order; each keeps the fold of its position in perm
+        positions = n_read + np.argsort(perm[n_read:n_samples], kind='mergesort')
+        for start in range(0, positions.size, chunk_size):
+            chunk_positions = positions[start:start + chunk_size]
+            chunk = gather_rows(X, perm[chunk_positions])
+            folds = chunk_positions % n_folds
+            for i_folds in range(n_folds):
+                fold_moments[i_folds] = accumulate_moments(fold_moments[i_folds], chunk[folds == i_folds])
+        n_read = n_samples
+
+        # select_from_moments merges copies, so the accumulated fold moments are left intact
+        data, evecs = select_from_moments(fold_moments, ps)
+        data['perm'] = perm[:n_samples]
+        yield n_samples, data, evecs
+
+
+# pca_select given only the moments (n_samples, mean, scatter) of each fold
+def select_from_moments(fold_moments, ps):
+    total = fold_moments[0]
+    for moments in fold_moments[1:]:
+        total = merge_moments(total, moments)
+    ppca = ppca_model(moments=total)
+
+    LLs_xval = np.zeros((len(fold_moments),ps.size))
+    for i_folds, moments in enumerate(fold_moments):
+        ppca_xval = ppca_model(moments=downdate_moments(total, moments))
+        LLs_xval[i_folds,:] = ppca_xval.momentLogLikelihoods(moments,ps)
+
+    return _select_summary(ppca, LLs_xval, ps)
+
+
+# model selection criteria from the full-data model and the held-out log likelihoods of each fold
+def _select_summary(ppca, LLs_xval, ps):
+    n_samples, n_features = ppca.n_samples, ppca.n_features
+
     # compute p for full set using singular value thresholding
-    ppca = ppca_model(X)
     s = np.sqrt(ppca.evals*n_samples)
     tau = optimal_svht_coef(n_features/n_samples,False)*np.median(s)
     p_threshold = np.where(s<tau)[0][0]-1
@@ -24,20 +112,7 @@ def pca_select(X, ps, n_folds=4):
     aic = -2.*ll_all+m*2.
     bic = -2.*ll_all+m*np.log(n_samples)
 
-    LLs_xval = np.zeros((n_folds,ps.size))
-    err_xval = np.zeros((n_folds,))
-    for i_folds in np.arange(n_folds):
-        testSet = folds[i_folds,:]
-        trainSet = folds[np.arange(n_folds)[~(np.arange(n_folds) == i_folds)],:].flatten()
-
-        Xtest = X[testSet,:]
-        Xtrain = X[trainSet,:]
-
-        ppca_xval = ppca_model(Xtrain)
-
-        for p_idx,p in enumerate(ps):
-            LLs_xval[i_folds,p_idx] = ppca_xval.logLikelihood(Xtest,p)
-        err_xval[i_folds] = ps[np.argmax(LLs_xval[i_folds,:])]
+    err_xval = ps[np.argmax(LLs_xval,axis=1)].astype(float)
 
     ll_xval=np.mean(LLs_xval,axis=0)
 
@@ -45,3 +120,143 @@ def pca_select(X, ps, n_folds=4):
             'll_xval': ll_xval, 'err_xval': err_xval, 'bic': bic, 'aic': aic}
 
     return data, ppca.evecs
+
+
+# Factor analysis log likelihoods of Xtest (average per sample, as FactorAnalysis.score) for every number of
+# factors in ks. ks is split into n_jobs contiguous ranges fit in a process pool (sharing Xtrain and Xtest
+# through a memmap as in pca_select); within a range each fit is warm-started from the noise variances and
+# loadings of the previous k. With checkpoint_dir, the results for each k (test and train log likelihoods, noise
+# variances, iterations) are saved to k<k>.npz as soon as the fit is done, and ks that already have a file are
+# loaded instead of refit, so an interrupted sweep can be resumed. The directory also holds a fingerprint of
+# the sweep (shapes, dtypes, first and last rows of the data, ks and fa_kwargs), and a ValueError is raised
+# rather than reusing checkpoints of a different sweep. fa_kwargs are passed to fa_model.
+def fa_sweep(Xtrain, Xtest, ks, checkpoint_dir=None, n_jobs=1, blas_threads=None, **fa_kwargs):
+    ks = np.sort(ks)
+    if checkpoint_dir is not None:
+        _check_fingerprint(checkpoint_dir, _fa_sweep_fingerprint(Xtrain, Xtest, ks, fa_kwargs))
+    jobs = [(k_range, checkpoint_dir) for k_range in np.array_split(ks, n_jobs) if k_range.size]
+
+    if n_jobs == 1:
+        results = [_fa_sweep_job(Xtrain, Xtest, job, fa_kwargs) for job in jobs]
+    else:
+        results = _run_shared((Xtrain, Xtest), _fa_sweep_job_shared, jobs, fa_kwargs, n_jobs,
+                              blas_threads)
+    ll = np.concatenate(results)
+    return {'ks': ks, 'll_test': ll[:,0], 'll_train': ll[:,1]}
+
+
+def _fa_sweep_fingerprint(Xtrain, Xtest, ks, fa_kwargs):
+    data = [(X.shape, str(X.dtype), np.asarray(X[0], dtype=np.float64).tolist(),
+             np.asarray(X[-1], dtype=np.float64).tolist()) if X.shape[0] else (X.shape, str(X.dtype))
+            for X in (Xtrain, Xtest)]
+    return {'data': data, 'ks': ks.tolist(), 'fa_kwargs': sorted((key, repr(value)) for key, value in fa_kwargs.items())}
+
+
+# creates directory with the given fingerprint, or checks that it matches the one saved there
+def _check_fingerprint(directory, fingerprint):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fname = os.path.join(directory, 'fingerprint.pkl')
+    if os.path.exists(fname):
+        if pickle.load(open(fname, 'rb')) != fingerprint:
+            raise ValueError("checkpoints in %s are from a different sweep (data, ks or fa_kwargs); use another "
+                             "directory or remove it" % directory)
+    else:
+        pickle.dump(fingerprint, open(fname, 'wb'))
+
+
+def _fa_sweep_job(Xtrain, Xtest, job, fa_kwargs):
+    ks, checkpoint_dir = job
+    ll = np.zeros((ks.size, 2))
+    warm = {}
+    for i, k in enumerate(ks):
+        fname = None if checkpoint_dir is None else os.path.join(checkpoint_dir, 'k%d.npz' % k)
+        if fname is not None and os.path.exists(fname):
+            saved = np.load(fname)
+            ll[i] = saved['ll_test'], saved['ll_train']
+            warm = {'noise_variance_init': saved['variance']}
+            continue
+        fa = fa_model(Xtrain, k, fit_type='native', **dict(fa_kwargs, **warm))
+        ll[i] = fa.score(Xtest), fa.ll[-1]/fa.n_samples
+        warm = {'noise_variance_init': fa.variance, 'components_init': fa.components}
+        if fname is not None:
+            np.savez(fname, ll_test=ll[i,0], ll_train=ll[i,1], variance=fa.variance, n_iters=fa.n_iters)
+    return ll
+
+
+def _fa_sweep_job_shared(args):
+    sources, job, fa_kwargs = args
+    Xtrain, Xtest = _open_shared(sources)
+    return _fa_sweep_job(Xtrain, Xtest, job, fa_kwargs)
+
+
+# fits the full data (job is None) or returns the held-out log likelihoods of one fold
+def _select_job(X, job, ps):
+    if job is None:
+        return ppca_model(X)
+    trainSet, testSet = job
+    ppca_xval = ppca_model(X[trainSet,:])
+    return ppca_xval.logLikelihoods(X[testSet,:],ps)
+
+
+def _select_job_shared(args):
+    sources, job, ps = args
+    return _select_job(_open_shared(sources)[0], job, ps)
+
+
+# Runs func((sources, job, args)) for every job in a process pool, where X is an array or a tuple of arrays and
+# sources holds one read-only memmap spec per array for the workers to open with _open_shared. Memmaps backed by
+# a file (np.memmap or np.load with mmap_mode, C-contiguous) are passed as their file, offset, shape and dtype;
+# only arrays in memory are copied to a temporary .npy file.
+def _run_shared(X, func, jobs, args, n_jobs, blas_threads):
+    blocks = X if isinstance(X, tuple) else (X,)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sources = []
+        for i, block in enumerate(blocks):
+            source = _memmap_source(block)
+            if source is None:
+                source = os.path.join(tmpdir, 'X%d.npy' % i)
+                np.save(source, block)
+            sources.append(source)
+
+        pool = multiprocessing.Pool(n_jobs, initializer=_limit_blas_threads, initargs=(blas_threads,))
+        try:
+            return pool.map(func, [(sources, job, args) for job in jobs], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+# (filename, offset, shape, dtype) of a C-contiguous file-backed memmap, including slices of one, else None
+def _memmap_source(X):
+    if not isinstance(X, np.memmap) or X.filename is None or not X.flags.c_contiguous:
+        return None
+    root = X
+    while isinstance(root.base, np.memmap):
+        root = root.base
+    X.flush()
+    offset = root.offset + X.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+    return X.filename, offset, X.shape, X.dtype.str
+
+
+# read-only memmaps of the arrays shared by _run_shared
+def _open_shared(sources):
+    return tuple(np.load(source, mmap_mode='r') if isinstance(source, str) else
+                 np.memmap(source[0], dtype=source[3], mode='r', offset=source[1], shape=source[2])
+                 for source in sources)
+
+
+def _limit_blas_threads(n_threads):
+    if n_threads is None:
+        return
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(n_threads)
+    # the environment is only read when BLAS is loaded, so also change the running pools if possible
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=n_threads, user_api='blas')
@@ -1,14 +1,15 @@
 import numpy as np
 import scipy.linalg as la
 from scipy.optimize import nnls
-# from sklearn.decomposition import NMF
-from sklearn.decomposition.cdnmf_fast import _update_cdnmf_fast
-from sklearn.decomposition.nmf import _initialize_nmf
+
+from widefield.dimreduction.pca import working_dtype, randomized_svd
 
 
 class NMF:
-    def __init__(self, n_components=None, sparsity=None, sparsity_penalty=1., regularization=None, regularization_penalty=1.):
+    def __init__(self, n_components=None, sparsity=None, sparsity_penalty=1., regularization=None, regularization_penalty=1.,
+                 dtype=None):
         self.n_components = n_components
+        self.dtype = dtype  # dtype of data and factors (default: that of X)
         self.sparsity = sparsity
         self.sparsity_penalty = sparsity_penalty
         self.regularization = regularization
@@ -16,17 +17,22 @@ class NMF:
         #raise NotImplementedError("NMF not implemented yet")
 
     def fit(self, X, shuffle=False, max_iter=200, tol=1e-4, verbose=False, W=None, H=None):
-        # Fit X = W*H, implementing coordinate descent as in scikit-learn implementation
+        # Fit X = W*H, implementing coordinate descent as in scikit-learn implementation (see hals_update)
         n_samples, n_features = X.shape
         if self.n_components is None:
             self.n_components = min(n_samples, n_features)
-
-        # Initialize using sklearn method
-        Wtmp, Ht = _initialize_nmf(X, self.n_components)
-        if H is None:
-            H = (Ht.T).copy(order='C')
-        if W is None:
-            W = Wtmp
+        dtype = working_dtype(X, self.dtype)
+        X = np.asarray(X, dtype=dtype)
+
+        # Initialize with NNDSVD
+        if W is None or H is None:
+            Wtmp, Htmp = self.initialize_nmf(X, self.n_components)
+            if H is None:
+                H = Htmp
+            if W is None:
+                W = Wtmp
+        H = np.array(H, dtype=dtype, order='C')
+        W = np.array(W, dtype=dtype, order='C')
         # Determine whether or not to initialize matrices randomly
         # avg = np.sqrt(X.mean() / self.n_components)
         # if H is None:
@@ -71,10 +77,10 @@ class NMF:
                 break
 
             if verbose:
-                print("violation:", violation / violation_init)
+                print("violation: %g" % (violation / violation_init))
 
             if violation / violation_init <= tol:
-                print("Converged at iteration", i + 1)
+                print("Converged at iteration %d" % (i + 1))
                 break
 
         self.components = H
@@ -98,23 +104,23 @@ class NMF:
             permutation = np.random.permutation(n_components)
         else:
             permutation = np.arange(n_components)
-        # The following seems to be required on 64-bit Windows w/ Python 3.5.
-        permutation = np.asarray(permutation, dtype=np.intp)
-        return _update_cdnmf_fast(W, HHt, XHt, permutation)
+        return hals_update(W, HHt, XHt, permutation)
 
     def infer_latent(self, X, W=None, max_iter=100, shuffle=False, tol=1e-4, verbose=False):
         # Fit X = W*H, using H as already found from fitting above
         n_samples, n_features = X.shape
         if self.n_components is None:
             self.n_components = min(n_samples, n_features)
+        dtype = working_dtype(X, self.dtype)
+        X = np.asarray(X, dtype=dtype)
 
         # Determine whether or not to initialize W randomly
-        avg = np.sqrt(X.mean() / self.n_components)
+        avg = np.sqrt(X.mean(dtype=np.float64) / self.n_components)
         if W is None:
-            W = avg * np.random.randn(n_samples, self.n_components)
+            W = (avg * np.random.randn(n_samples, self.n_components)).astype(dtype)
             np.abs(W, W)
         else:
-            W = np.copy(W)
+            W = np.array(W, dtype=dtype)
 
         l1_W, l2_W = 0, 0
         if self.sparsity in ('both', 'transformation'):
@@ -135,10 +141,10 @@ class NMF:
                 break
 
             if verbose:
-                print("violation:", violation / violation_init)
+                print("violation: %g" % (violation / violation_init))
 
             if violation / violation_init <= tol:
-                print("Converged at iteration", i + 1)
+                print("Converged at iteration %d" % (i + 1))
                 break
 
         return W
@@ -150,10 +156,10 @@ class NMF:
 
     def initialize_nmf(self, X, n_components):
         n_samples, n_features = X.shape
-        W = np.empty((n_samples, n_components))
-        H = np.empty((n_features, n_components))
+        W = np.empty((n_samples, n_components), dtype=X.dtype)
+        H = np.empty((n_features, n_components), dtype=X.dtype)
 
-        U,s,V = la.svd(X, full_matrices=False)
+        U,s,V = randomized_svd(X, n_components)
         W[:,0] = np.sqrt(s[0])*np.abs(U[:,0])
         H[:,0] = np.sqrt(s[0])*np.abs(V[0])
         for i in range(1, n_components):
@@ -173,10 +179,12 @@ class NMF:
                 u = xp/xpnrm
                 v = yp/ypnrm
                 sigma = mp
-            else:
+            elif mn > 0:
                 u = xn/xnnrm
                 v = yn/ynnrm
                 sigma = mn
+            else:
+                u, v, sigma = 0., 0., 0.
             W[:,i] = np.sqrt(s[i]*sigma)*u
             H[:,i] = np.sqrt(s[i]*sigma)*v
 
@@ -219,7 +227,7 @@ class NMF:
 
             objective_new = np.sum((Xin - np.dot(W,H.T))**2) + l1_H*np.sum(np.sum(np.abs(H),axis=1)**2) + l1_W*np.sum(np.sum(np.abs(W),axis=1)**2) + l2_H*np.sum(H**2) + l2_W*np.sum(W**2)
             if objective_new > objective:
-                print "warning: objective value increased"
+                print("warning: objective value increased")
             objective = objective_new
 
             # ---------- UPDATE H ----------
@@ -233,7 +241,7 @@ class NMF:
 
             objective_new = np.sum((Xin - np.dot(W,H.T))**2) + l1_H*np.sum(np.sum(np.abs(H),axis=1)**2) + l1_W*np.sum(np.sum(np.abs(W),axis=1)**2) + l2_H*np.sum(H**2) + l2_W*np.sum(W**2)
             if objective_new > objective:
-                print "warning: objective value increased on iteration %d" % i
+                print("warning: objective value increased on iteration %d" % i)
                 break
             objective = objective_new
 
@@ -241,9 +249,26 @@ class NMF:
         return W
 
 
+# One sweep of coordinate descent on W >= 0 for min ||X - W H^T||^2 given HHt = H^T H and XHt = X H (with the l1/l2
+# penalties folded in), updating the columns of W in the order permutation. Each column is updated for all rows
+# at once, which is the same update as sklearn's _update_cdnmf_fast (its rows are independent within a column).
+# Returns the sum of absolute projected gradients before each column update.
+def hals_update(W, HHt, XHt, permutation):
+    violation = 0.
+    for t in permutation:
+        grad = np.dot(W, HHt[:,t]) - XHt[:,t]
+        pg = np.where(W[:,t] == 0, np.minimum(grad, 0), grad)
+        violation += np.sum(np.abs(pg), dtype=np.float64)
+        hess = HHt[t,t]
+        if hess != 0:
+            W[:,t] = np.maximum(W[:,t] - grad/hess, 0)
+    return violation
+
+
 class SemiNMF:
-    def __init__(self, n_components=None, sparsity_penalty=1., regularization_penalty=1.):
+    def __init__(self, n_components=None, sparsity_penalty=1., regularization_penalty=1., dtype=None):
         self.n_components = n_components
+        self.dtype = dtype  # dtype of data and factors (default: that of X)
         self.sparsity_penalty = sparsity_penalty
         self.regularization_penalty = regularization_penalty
         #raise NotImplementedError("NMF not implemented yet")
@@ -253,10 +278,12 @@ class SemiNMF:
         n_samples, n_features = X.shape
         if self.n_components is None:
             self.n_components = min(n_samples, n_features)
+        X = np.asarray(X, dtype=working_dtype(X, self.dtype))
 
         # Initialize matrices
         if H is not None:
-            W = np.empty((n_samples, self.n_components))
+            H = np.asarray(H, dtype=X.dtype)
+            W = np.empty((n_samples, self.n_components), dtype=X.dtype)
             for i in range(n_samples):
                 W[i] = np.linalg.lstsq(H,X[i])[0]
         else:
@@ -289,11 +316,11 @@ class SemiNMF:
 
             obj = np.sum((X - np.dot(W,H.T))**2)/2. + lambda2/2.*np.sum(W**2) + lambda1*np.sum(np.abs(H))
             if obj_last - obj < 0:
-                print "warning: objective function increased on iteration %d" % i
+                print("warning: objective function increased on iteration %d" % i)
             if obj_last - obj < tol:
-                print "converged on iteration %d" % i
+                print("converged on iteration %d" % i)
             if verbose:
-                print obj_last - obj
+                print(obj_last - obj)
             obj_last = obj
 
         self.components = H
@@ -301,8 +328,8 @@ class SemiNMF:
 
     def initialize_nmf(self, X, n_components):
         n_samples, n_features = X.shape
-        W = np.empty((n_samples, n_components))
-        H = np.empty((n_features, n_components))
+        W = np.empty((n_samples, n_components), dtype=X.dtype)
+        H = np.empty((n_features, n_components), dtype=X.dtype)
 
         U,s,V = la.svd(X, full_matrices=False)
         W[:,0] = np.sqrt(s[0])*U[:,0]
@@ -351,8 +378,9 @@ class SemiNMF:
 
 class SparseNMF:
     # Reference: "Sparse NMF, half-baked or well done?"
-    def __init__(self, n_components=None, cf='KL', beta=1.0, sparsity_penalty=0.0, max_iter=200, tol=1e-4):
+    def __init__(self, n_components=None, cf='KL', beta=1.0, sparsity_penalty=0.0, max_iter=200, tol=1e-4, dtype=None):
         self.n_components = n_components
+        self.dtype = dtype  # dtype of data and factors (default: that of X)
         self.sparsity_penalty = sparsity_penalty
         self.max_iter = max_iter
         self.beta = beta
@@ -363,10 +391,11 @@ class SparseNMF:
         n_samples, n_features = X.shape
         if self.n_components is None:
             self.n_components = min(n_samples, n_features)
+        X = np.asarray(X, dtype=working_dtype(X, self.dtype))
 
         # initialize W and H
-        W = np.random.rand(n_samples, self.n_components)
-        H = np.random.rand(self.n_components, n_features)
+        W = np.random.rand(n_samples, self.n_components).astype(X.dtype)
+        H = np.random.rand(self.n_components, n_features).astype(X.dtype)
 
         # sparsity per matrix entry - still figuring out what this means
         # if length(params.sparsity) == 1
@@ -374,7 +403,7 @@ class SparseNMF:
         # elseif size(params.sparsity, 2) == 1
         # params.sparsity = repmat(params.sparsity, 1, n);
         # end
-        sparsity = np.ones((self.n_components, n_features))*self.sparsity_penalty
+        sparsity = np.ones((self.n_components, n_features), dtype=X.dtype)*self.sparsity_penalty
 
         # Normalize the columns of W and rescale H accordingly
         Wn = np.sqrt(np.sum(W**2,axis=0))
@@ -454,13 +483,13 @@ class SparseNMF:
             obj_cost[i] = cost
 
             if display:
-                print "iteration %d div = %.3e cost = %.3e\n" % (i, div, cost)
+                print("iteration %d div = %.3e cost = %.3e\n" % (i, div, cost))
 
             # Convergence check
             if i > 1:
                 e = np.abs(cost - last_cost) / last_cost
             if cost >= last_cost:
-                print "cost increased on iteration %d" % i
+                print("cost increased on iteration %d" % i)
                 break
             elif last_cost - cost < self.tol:
                 break
@@ -472,7 +501,8 @@ class SparseNMF:
 
     def infer_latent(self, X, w_ind=None):
         n_samples, n_features = X.shape
-        W = np.random.rand(n_samples, self.n_components)
+        X = np.asarray(X, dtype=working_dtype(X, self.dtype))
+        W = np.random.rand(n_samples, self.n_components).astype(X.dtype)
         W /= np.sqrt(np.sum(W**2,axis=0))
         H = self.components
         lam = np.maximum(np.dot(W,H), self.flr)
@@ -1,15 +1,28 @@
 from __future__ import division
 import scipy.integrate
+import scipy.optimize
 import numpy as np
 
-# Code modified from MATLAB. beta must be a number, not a vector.
+# Code modified from MATLAB. beta may be a number or an array of aspect ratios; beta > 1 is treated as the
+# aspect ratio 1/beta of the transposed matrix.
 
+# grid of beta for the interpolation table of Marcenko-Pastur medians, built on first use
+table_betas = np.linspace(0.001, 1., 200)
+_median_table = None
+# exact medians computed so far, by beta
+_median_cache = {}
 
-def optimal_svht_coef(beta,sigma_known):
+
+def optimal_svht_coef(beta,sigma_known,exact=False):
+    beta = np.asarray(beta, dtype=np.float64)
+    if np.any(beta <= 0) or np.any(~np.isfinite(beta)):
+        raise ValueError("beta=%r must be positive" % beta)
+    beta = np.minimum(beta, 1./beta)
     if sigma_known:
-        return optimal_svht_coef_sigma_known(beta)
+        coef = optimal_svht_coef_sigma_known(beta)
     else:
-        return optimal_svht_coef_sigma_unknown(beta)
+        coef = optimal_svht_coef_sigma_unknown(beta, exact)
+    return coef if coef.ndim else coef[()]
 
 
 def optimal_svht_coef_sigma_known(beta):
@@ -17,14 +30,54 @@ def optimal_svht_coef_sigma_known(beta):
     return np.sqrt(2.*(beta+1.)+w)
 
 
-def optimal_svht_coef_sigma_unknown(beta):
+# exact=True solves for the median of every distinct beta instead of interpolating the table
+def optimal_svht_coef_sigma_unknown(beta, exact=False):
     coef = optimal_svht_coef_sigma_known(beta)
 
-    MPmedian = medianMarcenkoPastur(beta)
+    MPmedian = medianMarcenkoPasturTable(beta, exact)
     omega = coef / np.sqrt(MPmedian)
     return omega
 
 
+# Medians of the Marcenko-Pastur distribution for an array of beta in (0, 1]. Values are interpolated (cubic
+# Hermite, accurate to ~1e-7) from a table of exact medians over table_betas; beta below the table and
+# exact=True use medianMarcenkoPasturExact, which is memoized per beta.
+def medianMarcenkoPasturTable(beta, exact=False):
+    global _median_table
+    beta = np.asarray(beta, dtype=np.float64)
+    flat = beta.ravel()
+    refine = np.ones(flat.shape, dtype=bool) if exact else flat < table_betas[0]
+
+    medians = np.empty(flat.shape)
+    if not np.all(refine):
+        if _median_table is None:
+            m = np.array([medianMarcenkoPasturExact(b) for b in table_betas])
+            _median_table = (m, np.gradient(m, table_betas))
+        medians[~refine] = hermite_interp(flat[~refine], table_betas, _median_table[0], _median_table[1])
+    for i in np.flatnonzero(refine):
+        medians[i] = medianMarcenkoPasturExact(flat[i])
+    return medians.reshape(beta.shape)
+
+
+def hermite_interp(x, xp, fp, dfp):
+    i = np.clip(np.searchsorted(xp, x) - 1, 0, xp.size - 2)
+    h = xp[i+1] - xp[i]
+    t = (x - xp[i])/h
+    return (fp[i]*(1 + 2*t)*(1 - t)**2 + dfp[i]*h*t*(1 - t)**2 +
+            fp[i+1]*t**2*(3 - 2*t) - dfp[i+1]*h*t**2*(1 - t))
+
+
+# Median of the Marcenko-Pastur distribution by root finding on its distribution function
+def medianMarcenkoPasturExact(beta):
+    beta = float(beta)
+    if beta not in _median_cache:
+        lobnd = (1.-np.sqrt(beta))**2
+        hibnd = (1.+np.sqrt(beta))**2
+        _median_cache[beta] = scipy.optimize.brentq(lambda x: 0.5 - incMarPas(x,beta,0), lobnd, hibnd,
+                                                     xtol=1e-13, rtol=1e-13)
+    return _median_cache[beta]
+
+
 def medianMarcenkoPastur(beta):
     MarPas = lambda x: 1-incMarPas(x,beta,0)
     lobnd = (1.-np.sqrt(beta))**2
@@ -53,7 +106,7 @@ def incMarPas(x0,beta,gamma):
     topSpec = (1.+np.sqrt(beta))**2
     botSpec = (1.-np.sqrt(beta))**2
     MarPas = lambda x: IfElse((topSpec-x)*(x-botSpec) > 0,
-                              np.sqrt((topSpec-x)*(x-botSpec))/(beta*x)/(2.*np.pi))
+                              np.sqrt(max((topSpec-x)*(x-botSpec), 0.))/(beta*x)/(2.*np.pi))
 
     if gamma != 0:
         f = lambda x: (x**gamma * MarPas(x))
@@ -66,7 +119,6 @@ def incMarPas(x0,beta,gamma):
 
 def IfElse(Q,point):
     y = point
-    notQ = np.where(np.logical_not(Q))[0]
-    if notQ.size != 0:
+    if not np.all(Q):
         y = 0.
     return y
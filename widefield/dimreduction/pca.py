@@ -2,19 +2,61 @@ import numpy as np
 import scipy.linalg as la
 import scipy.special as special
 
+from widefield.dimreduction.lowrank_gaussian import lowrank_log_likelihoods
+from widefield.tools.chunk_tools import iter_chunks, map_chunks, chunk_size as default_chunk_size
+
 # center columns
 def centerCols(X):
     mu = np.mean(X, axis=0)
     return X - mu
 
 
+# dtype in which data and factors are kept: dtype if given, otherwise that of X (float64 for integer data).
+# Reductions (means, Gram matrices, log likelihoods) are accumulated in float64 either way.
+def working_dtype(X, dtype=None):
+    if dtype is not None:
+        return np.dtype(dtype)
+    if np.issubdtype(X.dtype, np.floating):
+        return X.dtype
+    return np.dtype(np.float64)
+
+
+# subtract a (float64) mean from Xin, with the result in dtype
+def subtract_mean(Xin, mean, dtype):
+    return np.asarray(Xin, dtype=dtype) - mean.astype(dtype)
+
+
+# squared Frobenius norm accumulated in float64
+def sq_norm(X):
+    return np.einsum('ij,ij->', X, X, dtype=np.float64)
+
+
+# X^T X accumulated in float64 one chunk of rows at a time
+def gram(X, chunk_size=default_chunk_size):
+    G = np.zeros((X.shape[1], X.shape[1]))
+    for chunk in iter_chunks(X, chunk_size):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        G += np.dot(chunk.T, chunk)
+    return G
+
+
 class pca_model:
-    def __init__(self, Xin, n_components=None, fitWith='SVD', max_iters=1000):
+    def __init__(self, Xin, n_components=None, fitWith='SVD', max_iters=1000, n_oversamples=10, n_power_iter=2,
+                 seed=None, chunk_size=default_chunk_size, dtype=None, W_init=None, tol=1e-6, verbose=False):
         self.n_samples, self.n_features = Xin.shape
-
-        # Center data
-        self.mean = np.mean(Xin, axis=0)
-        X = Xin - self.mean
+        self.dtype = working_dtype(Xin, dtype)
+
+        # EM on memmaps and PyTables arrays streams the data instead of centering it in memory
+        streamEM = fitWith == 'EM' and (isinstance(Xin, np.memmap) or not isinstance(Xin, np.ndarray))
+        if fitWith == 'covariance':
+            # stream Xin (ndarray, memmap or PyTables array) instead of centering it in memory
+            n, self.mean, scatter = streaming_moments(Xin, chunk_size)
+        elif streamEM:
+            self.mean = streaming_mean(Xin, chunk_size)
+        else:
+            # Center data
+            self.mean = np.mean(Xin, axis=0, dtype=np.float64)
+            X = subtract_mean(Xin, self.mean, self.dtype)
 
         if n_components is None:
             self.n_components = min(self.n_features,self.n_samples)
@@ -30,42 +72,46 @@ class pca_model:
 
         if fitWith == 'SVD':
             self.fitSVD(X)
+        elif fitWith == 'randomized':
+            self.fitRandomized(X, n_oversamples, n_power_iter, seed)
+        elif fitWith == 'covariance':
+            self.fitCovariance(scatter/self.n_samples)
+        elif streamEM:
+            self.fitEM(Xin, max_iters, W_init, tol, self.mean, chunk_size, verbose)
         elif fitWith == 'EM':
-            self.fitEM(X, max_iters)
+            self.fitEM(X, max_iters, W_init, tol, verbose=verbose)
         elif fitWith == 'EM_noconstraint':
             self.fitEM_noconstraint(X, max_iters)
 
     def fitSVD(self, X):
         U, S, V = la.svd(X, full_matrices=False)
-        self.evals = (S ** 2) / self.n_samples
+        self.evals = (S.astype(np.float64) ** 2) / self.n_samples
         self.evecs = V.T
         self.components = self.evecs[:,:self.n_components]
 
-    def fitEM(self, X, max_iters):
-        # NOTE: PCA model fit with EM may not have all values for evals and evecs
-        W = np.random.randn(self.n_features, self.n_components)
-
-        err = []
-        for i in range(0, max_iters):
-            # new constrained algorithm - gives W orthogonal but not orthonormal
-            Minv = la.lapack.flapack.dtrtri(np.tril(np.dot(W.T,W)).T)[0].T
-            XW = np.dot(X,W)
-            Z = np.dot(Minv, XW.T)
-            ZZt = np.triu(np.dot(Z,Z.T))
-            SW = np.dot(X.T, XW)
-            W = np.dot(SW, np.dot(Minv.T, la.lapack.flapack.dtrtri(ZZt)[0]))
+    def fitRandomized(self, X, n_oversamples, n_power_iter, seed):
+        # NOTE: only the leading n_components evals and evecs are computed
+        U, S, V = randomized_svd(X, self.n_components, n_oversamples, n_power_iter, seed)
+        self.evals = (S.astype(np.float64) ** 2) / self.n_samples
+        self.evecs = V.T
+        self.components = self.evecs
 
-            err.append(la.norm(X.T - np.dot(W, Z)))
-            if i > 0 and np.abs(err[i] - err[i-1]) < 1e-6:
-                break
+    def fitCovariance(self, C):
+        self.evals, self.evecs = covariance_eig(C, min(self.n_samples, self.n_features))
+        self.evecs = self.evecs.astype(self.dtype, copy=False)
+        self.components = self.evecs[:,:self.n_components]
 
+    def fitEM(self, X, max_iters, W_init=None, tol=1e-6, mean=None, chunk_size=default_chunk_size, verbose=False):
+        # NOTE: PCA model fit with EM may not have all values for evals and evecs
+        # X is centered, or streamed in chunks with mean subtracted on the fly (see pcaEM)
+        W, self.EMerr = pcaEM(X, self.n_components, max_iters, W_init, tol, mean, chunk_size, verbose,
+                              return_err=True, dtype=self.dtype)
         self.components = W/np.sqrt(np.sum(np.abs(W)**2,axis=0))   # normalize
-        self.evals = np.diag(np.dot(np.dot(W.T,X.T),np.dot(X,W)))/self.n_samples
-        self.EMerr = np.array(err)
+        self.evals = projected_sq_norms(X, self.components, mean, chunk_size)/self.n_samples
 
     def fitEM_noconstraint(self, X, max_iters):
         # NOTE: PCA model fit with EM will not have values for evals and evecs
-        W = np.random.randn(self.n_features, self.n_components)
+        W = np.random.randn(self.n_features, self.n_components).astype(self.dtype)
 
         err = []
         for i in range(0, max_iters):
@@ -85,7 +131,7 @@ class pca_model:
         self.EMerr = np.array(err)
 
     def inferLatent(self,X):
-        return np.dot(X - self.mean,self.components)
+        return np.dot(subtract_mean(X, self.mean, self.dtype),self.components)
 
     def reconstruct(self,X):
         Z = self.inferLatent(X)
@@ -93,20 +139,34 @@ class pca_model:
         return Xnew
 
     def changeNumComponents(self,n_components):
-        if not 1 <= n_components <= self.n_features:
-            raise ValueError("n_components=%r invalid for n_features=%d" % (n_components, self.n_features))
+        if not 1 <= n_components <= self.evecs.shape[1]:
+            raise ValueError("n_components=%r invalid for %d fitted evecs" % (n_components, self.evecs.shape[1]))
         self.n_components = n_components
         self.components = self.evecs[:,:n_components]
         return self
 
 
 class ppca_model:
-    def __init__(self, Xin, n_components=None, fitWith='SVD', max_iters=500):
-        self.n_samples, self.n_features = Xin.shape
+    def __init__(self, Xin=None, n_components=None, fitWith='SVD', max_iters=500, n_oversamples=10, n_power_iter=2,
+                 seed=None, chunk_size=default_chunk_size, moments=None, dtype=None):
+        if moments is not None:
+            # fit from precomputed (n_samples, mean, scatter) rather than from data
+            fitWith = 'covariance'
+            self.n_samples, self.mean, scatter = moments
+            self.n_features = self.mean.size
+            self.dtype = np.dtype(np.float64 if dtype is None else dtype)
+        elif fitWith == 'covariance':
+            # stream Xin (ndarray, memmap or PyTables array) instead of centering it in memory
+            self.n_samples, self.n_features = Xin.shape
+            self.dtype = working_dtype(Xin, dtype)
+            n, self.mean, scatter = streaming_moments(Xin, chunk_size)
+        else:
+            self.n_samples, self.n_features = Xin.shape
+            self.dtype = working_dtype(Xin, dtype)
 
-        # Center data
-        self.mean = np.mean(Xin, axis=0)
-        X = Xin - self.mean
+            # Center data
+            self.mean = np.mean(Xin, axis=0, dtype=np.float64)
+            X = subtract_mean(Xin, self.mean, self.dtype)
 
         if n_components is not None:
             if not 0 <= n_components <= self.n_features:
@@ -120,11 +180,20 @@ class ppca_model:
         self.evecs = None
         self.components = None  # mapping
         self.s2 = None          # singular values
-        self.fitWith = fitWith  # either SVD or EM
+        self.fitWith = fitWith  # SVD, randomized, covariance or EM
         self.LLtrain = None
+        self.n_evals = min(self.n_samples, self.n_features)
+        self.evals_residual = 0.  # sum of the eigenvalues not in evals (truncated fits)
+        self.MW = None          # latent projection, cached by latentProjection
 
         if fitWith == 'SVD':
             self.fitSVD(X)
+        elif fitWith == 'randomized':
+            if self.n_components is None:
+                raise ValueError("n_components must be specified for randomized fit")
+            self.fitRandomized(X, n_oversamples, n_power_iter, seed)
+        elif fitWith == 'covariance':
+            self.fitCovariance(scatter/self.n_samples)
         elif fitWith == 'EM':
             if self.n_components is None:
                 self.n_components = min(self.n_samples, self.n_features)
@@ -132,7 +201,7 @@ class ppca_model:
 
     def fitSVD(self, X):
         U, S, V = la.svd(X, full_matrices=False)
-        self.evals = (S ** 2) / self.n_samples
+        self.evals = (S.astype(np.float64) ** 2) / self.n_samples
         self.evecs = V.T
         if self.n_components is not None:
             self.setComponents(self.n_components)
@@ -140,19 +209,42 @@ class ppca_model:
             # A=self.evecs[:,:self.n_components]
             # B=np.diag(np.sqrt((self.evals[:self.n_components] - self.s2 * np.ones([1, self.n_components])).flatten()))
             # self.components = np.dot(A,B)
-        pmax = min(self.n_samples,self.n_features)
-        self.LLtrain = np.zeros((pmax,))
-        pmaxf=float(pmax)
-        for i in range(pmax-1):
-            p=i+1
-            s2 = self.evals[p:].mean()
-            self.LLtrain[i] = -self.n_samples/2.*(pmaxf*np.log(2.*np.pi)+np.sum(np.log(self.evals[:p]))
-                                             +(pmaxf-p)*np.log(s2)+pmaxf)
-        self.LLtrain[pmax-1] = -self.n_samples/2.*(pmaxf*np.log(2.*np.pi)+np.sum(np.log(self.evals))+pmaxf)
+        self.computeLLtrain()
+
+    def fitRandomized(self, X, n_oversamples, n_power_iter, seed):
+        # NOTE: only the leading n_components evals and evecs are computed; the variance in the
+        # remaining directions is kept in evals_residual so that s2 and LLtrain are the same as for SVD
+        U, S, V = randomized_svd(X, self.n_components, n_oversamples, n_power_iter, seed)
+        self.evals = (S.astype(np.float64) ** 2) / self.n_samples
+        self.evecs = V.T
+        self.evals_residual = max(sq_norm(X)/self.n_samples - np.sum(self.evals), 0.)
+        self.setComponents(self.n_components)
+        self.computeLLtrain()
+
+    def fitCovariance(self, C):
+        self.evals, self.evecs = covariance_eig(C, self.n_evals)
+        self.evecs = self.evecs.astype(self.dtype, copy=False)
+        if self.n_components is not None:
+            self.setComponents(self.n_components)
+        self.computeLLtrain()
+
+    # training log likelihood for every number of components that evals allows
+    def computeLLtrain(self):
+        self.LLtrain = self.trainLogLikelihoods(np.arange(1, self.evals.size+1))
+
+    # training log likelihoods for a vector of numbers of components, using cumulative sums of evals
+    def trainLogLikelihoods(self, ps):
+        ps = np.asarray(ps, dtype=int)
+        pmax = float(self.n_evals)
+        s2 = self.noiseVariances(ps)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            LLs2 = np.where(ps < pmax, (pmax-ps)*np.log(s2), 0.)
+        LLdetC = np.cumsum(np.log(self.evals))[ps-1] + LLs2
+        return -self.n_samples/2.*(pmax*np.log(2.*np.pi)+LLdetC+pmax)
 
     def fitEM(self, X, max_iters):
-        W = np.random.randn(self.n_features,self.n_components)
-        cX = np.dot(X.T,X)/self.n_samples
+        W = np.random.randn(self.n_features,self.n_components).astype(self.dtype)
+        cX = gram(X)/self.n_samples
         s2 = np.mean(np.diag(cX))
 
         const = -self.n_features*0.5*np.log(2*np.pi)
@@ -175,41 +267,72 @@ class ppca_model:
                 break
 
         self.components = np.dot(SW,la.inv(s2*np.identity(self.n_components)+np.dot(Minv,np.dot(W.T,SW))))
-        self.s2 = np.mean(np.std(X,axis=0)**2-np.diag(np.dot(SW,np.dot(Minv,W.T))))
+        self.components = self.components.astype(self.dtype, copy=False)
+        self.s2 = np.mean(np.var(X,axis=0,dtype=np.float64)-np.diag(np.dot(SW,np.dot(Minv,W.T))))
         self.LL = np.array(LL)
-
-    def inferLatent(self, Xin, n_components=None):
+        self.MW = None
+
+    # W (W^T W + s2 I)^-1, mapping centered data to the posterior mean of the latents. Computed once per set of
+    # components; setComponents and fitEM reset it.
+    def latentProjection(self):
+        if self.MW is None:
+            W = self.components.astype(np.float64)
+            M = np.dot(W.T, W) + self.s2*np.identity(W.shape[1])
+            self.MW = la.cho_solve(la.cho_factor(M), W.T).T.astype(self.dtype)
+        return self.MW
+
+    # Xin may be an array, memmap, PyTables array or an iterable of row chunks; the result is written into out
+    # (e.g. a memmap) if given, one chunk at a time
+    def inferLatent(self, Xin, n_components=None, out=None, chunk_size=default_chunk_size):
         if (n_components is not None) and (self.n_components != n_components):
             self.setComponents(n_components)
-        X = Xin - self.mean
-        U,S,V=la.svd(self.components,full_matrices=False)
-        Minv = np.dot(V.T*(1./(S**2+self.s2)),V)
-        MW=np.dot(self.components,Minv.T)
-        return np.dot(X,MW)
+        MW = self.latentProjection()
+        return map_chunks(Xin, lambda chunk: np.dot(subtract_mean(chunk, self.mean, self.dtype), MW),
+                          MW.shape[1], self.dtype, out, chunk_size)
 
-    def reconstruct(self, Xin, n_components=None):
-        Z = self.inferLatent(Xin,n_components)
-        X = np.dot(Z,self.components.T)
-        return X
+    def reconstruct(self, Xin, n_components=None, out=None, chunk_size=default_chunk_size):
+        if (n_components is not None) and (self.n_components != n_components):
+            self.setComponents(n_components)
+        MW = self.latentProjection()
+        return map_chunks(Xin, lambda chunk: np.dot(np.dot(subtract_mean(chunk, self.mean, self.dtype), MW),
+                                                    self.components.T),
+                          self.n_features, self.dtype, out, chunk_size)
 
     def setComponents(self, n_components):
         if self.fitWith == 'EM':
             raise TypeError("Cannot change number of components for PPCA model fit with EM")
-        if not 1 <= n_components <= self.n_features:
-            raise ValueError("n_components=%r invalid for n_features=%d"
-                             % (n_components, self.n_features))
-        self.s2 = np.mean(self.evals[n_components:])
+        if not 1 <= n_components <= self.evals.size:
+            raise ValueError("n_components=%r invalid for %d fitted evals"
+                             % (n_components, self.evals.size))
+        self.n_components = n_components
+        self.s2 = self.noiseVariance(n_components)
         self.components = np.dot(self.evecs[:,:n_components], np.diag(np.sqrt((self.evals[:n_components] - self.s2 * np.ones(n_components)).flatten())))
+        self.components = self.components.astype(self.dtype, copy=False)
+        self.MW = None
         return self
 
+    # mean of the eigenvalues of the discarded directions
+    def noiseVariance(self, n_components):
+        if self.evals_residual == 0.:
+            return np.mean(self.evals[n_components:])
+        return (np.sum(self.evals[n_components:]) + self.evals_residual)/(self.n_evals - n_components)
+
+    # noiseVariance for a vector of numbers of components (nan where no directions are discarded)
+    def noiseVariances(self, ps):
+        ps = np.asarray(ps, dtype=int)
+        tail = np.append(np.cumsum(self.evals[::-1])[::-1], 0.) + self.evals_residual
+        n_discarded = self.n_evals - ps
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(n_discarded > 0, tail[ps]/n_discarded, np.nan)
+
     # Get the log likelihood of a PPCA model with test data and any number of components.
     def logLikelihood(self, Xin, n_components, trainingData=False):
         n_samples, n_features = Xin.shape
         if n_features != self.n_features:
             raise ValueError("X.shape[1]=%d not equal to n_features=%d"
                              % (n_features, self.n_features))
-        s2=np.mean(self.evals[n_components:])
-        X = Xin - self.mean
+        s2=self.noiseVariance(n_components)
+        X = subtract_mean(Xin, self.mean, self.dtype)
 
         # compute determinant term of LL
         LLdetC=(self.n_features-n_components)*np.log(s2)+np.sum(np.log(self.evals[0:n_components]))
@@ -225,90 +348,339 @@ class ppca_model:
         LL=np.sum(LLi)
         return LL
 
+    # Log likelihood of test data for every number of components in ps at once: a single projection onto
+    # the leading max(ps) evecs, then cumulative sums over components (same values as logLikelihood).
+    def logLikelihoods(self, Xin, ps):
+        n_samples, n_features = Xin.shape
+        if n_features != self.n_features:
+            raise ValueError("X.shape[1]=%d not equal to n_features=%d"
+                             % (n_features, self.n_features))
+        ps = np.asarray(ps, dtype=int)
+        X = subtract_mean(Xin, self.mean, self.dtype)
+        proj = np.dot(X, self.evecs[:,:np.max(ps)])
+        return self.projectedLogLikelihoods(n_samples, sq_norm(X), np.sum(proj*proj, axis=0, dtype=np.float64), ps)
+
+    # Log likelihoods from the summed squared norm of the centered test data (sq_norm) and the summed
+    # squared projections onto each evec (sq_proj)
+    def projectedLogLikelihoods(self, n_samples, sq_norm, sq_proj, ps):
+        s2 = self.noiseVariances(ps)
+        LLdetC = (self.n_features-ps)*np.log(s2) + np.cumsum(np.log(self.evals[:sq_proj.size]))[ps-1]
+        LLtr = (sq_norm - np.cumsum(sq_proj)[ps-1])/s2 + np.cumsum(sq_proj/self.evals[:sq_proj.size])[ps-1]
+        const = -self.n_features*0.5*np.log(2*np.pi)
+        return n_samples*const - 0.5*n_samples*LLdetC - 0.5*LLtr
+
+    # logLikelihoods of test data given only its moments (n_samples, mean, scatter)
+    def momentLogLikelihoods(self, moments, ps):
+        n_samples, mean, scatter = moments
+        if mean.size != self.n_features:
+            raise ValueError("mean.size=%d not equal to n_features=%d" % (mean.size, self.n_features))
+        ps = np.asarray(ps, dtype=int)
+        E = self.evecs[:,:np.max(ps)]
+        # scatter about the model mean rather than the test mean
+        shift = mean - self.mean
+        sq_norm = np.trace(scatter) + n_samples*np.dot(shift, shift)
+        sq_proj = np.sum(E*np.dot(scatter, E), axis=0) + n_samples*np.dot(shift, E)**2
+        return self.projectedLogLikelihoods(n_samples, sq_norm, sq_proj, ps)
+
+    # log likelihood of each row of Xin (array, memmap, PyTables array or iterable of row chunks) under the current
+    # components and s2, C = W W^T + s2 I, without forming C (see lowrank_gaussian); also for models fit with EM
+    def sampleLogLikelihoods(self, Xin, chunk_size=default_chunk_size):
+        return lowrank_log_likelihoods(Xin, self.mean, self.components.T, self.s2, chunk_size)
+
     def minkaEval(self,X,n_components):
         n_samples, n_features = X.shape
+        return minka_evidence(self.evals, n_samples, n_features, n_components)[0]
 
-        if n_components == n_features:
-            s2 = 1
-            pv = 0
-        else:
-            s2 = np.mean(self.evals[n_components:])
-            pv = -n_samples*(n_features-n_components)/2.*np.log(s2)
 
-        pl = -n_samples/2.*np.sum(np.log(self.evals[0:n_components]))
+# PCA updated one chunk of samples at a time (incremental SVD, Ross et al. 2008). The centered data seen so
+# far are represented by a rank n_components+n_buffer SVD; the extra buffer directions keep the leading
+# components accurate when the subspace rotates between updates.
+class ipca_model:
+    def __init__(self, n_components, n_buffer=10, dtype=None):
+        self.n_components = n_components
+        self.n_buffer = n_buffer
+        self.dtype = dtype
+        self.n_samples = 0
+        self.n_features = None
+        self.mean = None
+        self.scatter_total = 0.  # trace of the scatter matrix of all data seen so far
+
+        self.singular_values = None
+        self.evals = None
+        self.evecs = None
+        self.components = None
+        self.explained_variance_ratio = None
+        self.drift = None        # change in explained_variance_ratio from the last update
+        self.drift_history = []  # total absolute drift for every update
+
+    def partial_fit(self, chunk):
+        n_new, n_features = chunk.shape
+        mean_new = np.mean(chunk, axis=0, dtype=np.float64)
+
+        if self.n_samples == 0:
+            self.dtype = working_dtype(chunk, self.dtype)
+            self.n_features = n_features
+            n_samples = n_new
+            mean = mean_new
+            X = Xc = subtract_mean(chunk, mean_new, self.dtype)
+            self.scatter_total = sq_norm(Xc)
+        else:
+            if n_features != self.n_features:
+                raise ValueError("chunk.shape[1]=%d not equal to n_features=%d" % (n_features, self.n_features))
+            Xc = subtract_mean(chunk, mean_new, self.dtype)
+            n_samples = self.n_samples + n_new
+            delta = mean_new - self.mean
+            mean = self.mean + delta*(float(n_new)/n_samples)
+            # stack the current factorization, the new centered chunk and a row correcting for the mean shift
+            correction = np.sqrt(float(self.n_samples)*n_new/n_samples)*delta
+            X = np.vstack((self.singular_values[:,np.newaxis]*self.evecs.T, Xc, correction)).astype(self.dtype)
+            self.scatter_total += sq_norm(Xc) + np.dot(correction, correction)
 
-        m = n_features*n_components-n_components*(n_components+1.)/2.
-        pp = np.log(2.*np.pi)*(m+n_components+1.)/2.
+        U, S, V = la.svd(X, full_matrices=False)
+        rank = min(self.n_components + self.n_buffer, S.size)
+        self.n_samples = n_samples
+        self.mean = mean
+        self.singular_values = S[:rank]
+        self.evals = (self.singular_values.astype(np.float64) ** 2) / self.n_samples
+        self.evecs = V[:rank].T
+        self.components = self.evecs[:,:self.n_components]
 
-        evals_=self.evals.copy()
-        evals_[n_components:]=s2
-        pa=0.
-        for i in range(n_components):
-            for j in range(i+1, n_features):
-                pa += np.log(1./evals_[j]-1./evals_[i])+np.log(self.evals[i]-self.evals[j])+np.log(n_samples)
-        pa=-pa/2.
+        evr_old = self.explained_variance_ratio
+        self.explained_variance_ratio = self.evals[:self.n_components]/(self.scatter_total/self.n_samples)
+        if evr_old is not None:
+            k = min(evr_old.size, self.explained_variance_ratio.size)
+            self.drift = self.explained_variance_ratio[:k] - evr_old[:k]
+            self.drift_history.append(np.sum(np.abs(self.drift)))
+        return self
 
-        pu = -n_components*np.log(2.)
-        for i in range(1,n_components+1):
-            pu += special.gammaln((n_features-i+1)/2.)-np.log(np.pi)*(n_features-i+1)/2.
+    def inferLatent(self, X):
+        return np.dot(subtract_mean(X, self.mean, self.dtype), self.components)
 
-        return pu+pl+pv+pp+pa-n_components/2.*np.log(n_samples)
+    def reconstruct(self, X):
+        Z = self.inferLatent(X)
+        Xnew = np.dot(Z, self.components.T)
+        return Xnew
 
 
-# Standalone function for fitting PCA with EM
-def pcaEM(X, n_components, max_iters):
+# Sufficient statistics (n_samples, mean, scatter) of the rows of X, where scatter is the centered
+# X^T X. Accumulated in float64 so they can be merged across chunks without losing precision.
+def chunk_moments(X):
+    X = np.asarray(X, dtype=np.float64)
+    mean = np.mean(X, axis=0)
+    Xc = X - mean
+    return X.shape[0], mean, np.dot(Xc.T, Xc)
+
+
+# Combine the moments of two disjoint sets of samples (Chan, Golub & LeVeque pairwise update)
+def merge_moments(a, b):
+    na, mean_a, scatter_a = a
+    nb, mean_b, scatter_b = b
+    n = na + nb
+    delta = mean_b - mean_a
+    mean = mean_a + delta*(float(nb)/n)
+    scatter = scatter_a + scatter_b + np.outer(delta, delta)*(float(na)*nb/n)
+    return n, mean, scatter
+
+
+# Moments of the samples in b removed from those of a (b a subset of a), the inverse of merge_moments
+def downdate_moments(a, b):
+    na, mean_a, scatter_a = a
+    nb, mean_b, scatter_b = b
+    n = na - nb
+    mean = (na*mean_a - nb*mean_b)/float(n)
+    delta = mean_b - mean
+    scatter = scatter_a - scatter_b - np.outer(delta, delta)*(float(n)*nb/na)
+    return n, mean, scatter
+
+
+# Moments of rows start:stop of X computed one chunk at a time; X can be an ndarray, memmap or PyTables
+# array. Only a single d x d scatter matrix (plus one chunk-sized temporary) is held in memory.
+def streaming_moments(X, chunk_size=default_chunk_size, start=0, stop=None):
+    moments = None
+    for chunk in iter_chunks(X, chunk_size, start, stop):
+        moments = accumulate_moments(moments, chunk)
+    return moments
+
+
+# Adds the rows of chunk to moments (None for no samples yet), updating its scatter matrix in place
+def accumulate_moments(moments, chunk):
+    if chunk.shape[0] == 0:
+        return moments
+    nb, mean_b, scatter_b = chunk_moments(chunk)
+    if moments is None:
+        return nb, mean_b, scatter_b
+    n, mean, scatter = moments
+    delta = mean_b - mean
+    scatter += scatter_b
+    scatter += np.outer(delta, delta)*(float(n)*nb/(n + nb))
+    return n + nb, mean + delta*(float(nb)/(n + nb)), scatter
+
+
+# Eigendecomposition of a covariance matrix with eigenvalues in decreasing order, keeping at most
+# n_evals of them (the number of nonzero eigenvalues for min(n_samples, n_features))
+def covariance_eig(C, n_evals=None):
+    evals, evecs = la.eigh(C)
+    if n_evals is None:
+        n_evals = evals.size
+    evals = np.maximum(evals[::-1][:n_evals], 0.)
+    evecs = np.ascontiguousarray(evecs[:,::-1][:,:n_evals])
+    return evals, evecs
+
+
+# Randomized truncated SVD (Halko, Martinsson & Tropp 2011): project X onto n_components+n_oversamples
+# random directions, refine the range with n_power_iter power iterations and take the SVD of the small
+# projected matrix. Cost is O(n_samples*n_features*(n_components+n_oversamples)*(2*n_power_iter+2)) instead
+# of O(n_samples*n_features*min(n_samples,n_features)) for the full SVD. The error in the leading singular
+# values/vectors shrinks geometrically with n_power_iter (as (s[k+l]/s[k])**(2*n_power_iter+1)), so slowly
+# decaying spectra need more power iterations; n_power_iter=2 and n_oversamples=10 are usually accurate to
+# a few digits in the leading components, each extra power iteration costs two more passes over X.
+# init (n_features x m) warm-starts the range finder, e.g. with the right singular vectors of a nearby matrix;
+# it is padded with random directions up to n_components+n_oversamples. The small projected matrix Q^T X is
+# formed and decomposed in float64 (one chunk of rows at a time), so S keeps double precision for float32 X;
+# U and V are returned in the dtype of X.
+def randomized_svd(X, n_components, n_oversamples=10, n_power_iter=2, seed=None, init=None):
+    n_samples, n_features = X.shape
+    n_random = min(n_components + n_oversamples, n_samples, n_features)
+    rng = np.random.RandomState(seed)
+
+    if init is None:
+        Omega = rng.randn(n_features, n_random)
+    else:
+        init = init[:,:n_random]
+        Omega = np.hstack((init, rng.randn(n_features, n_random - init.shape[1])))
+    Q = np.dot(X, Omega.astype(X.dtype))
+    Q = la.qr(Q, mode='economic')[0]
+    for i in range(n_power_iter):
+        # re-orthonormalize between multiplications to avoid losing the smaller singular values
+        Q = la.qr(np.dot(X.T, Q), mode='economic')[0]
+        Q = la.qr(np.dot(X, Q), mode='economic')[0]
+
+    Q = la.qr(Q.astype(np.float64), mode='economic')[0]
+    B = np.zeros((Q.shape[1], n_features))
+    for start in range(0, n_samples, default_chunk_size):
+        stop = min(start + default_chunk_size, n_samples)
+        B += np.dot(Q[start:stop].T, np.asarray(X[start:stop], dtype=np.float64))
+    Uq, S, V = la.svd(B, full_matrices=False)
+    U = np.dot(Q, Uq[:,:n_components]).astype(X.dtype, copy=False)
+    return U, S[:n_components], V[:n_components].astype(X.dtype, copy=False)
+
+
+# Standalone function for fitting PCA with EM. Each iteration is one pass over the rows of X (ndarray, memmap
+# or PyTables array) in chunks, accumulating X^T(XW) and (XW)^T(XW) in float64, so X never has to be in memory.
+# mean is subtracted from every chunk (None if X is already centered). W_init warm-starts the fit, e.g. from
+# the components of a previous window or session. Iterations stop once the reconstruction error changes by
+# less than tol relative to the previous iteration; return_err=True also returns the error of every iteration.
+def pcaEM(X, n_components, max_iters, W_init=None, tol=1e-6, mean=None, chunk_size=default_chunk_size,
+          verbose=False, return_err=False, dtype=None):
         n_samples,n_features = X.shape
-        W = np.random.randn(n_features, n_components)
+        dtype = working_dtype(X, dtype)
+        if W_init is None:
+            W = np.random.randn(n_features, n_components).astype(dtype)
+        else:
+            W = np.array(W_init, dtype=dtype)
+            if W.shape != (n_features, n_components):
+                raise ValueError("W_init.shape=%r not equal to (%d, %d)" % (W.shape, n_features, n_components))
 
+        sqX = None
         err = []
         for i in range(0, max_iters):
             # constrained algorithm
-            Minv = la.lapack.flapack.dtrtri(np.tril(np.dot(W.T,W)).T)[0].T
-            XW = np.dot(X,W)
-            Z = np.dot(Minv, XW.T)
-            ZZt = np.triu(np.dot(Z,Z.T))
-            SW = np.dot(X.T, XW)
-            W = np.dot(SW, np.dot(Minv.T, la.lapack.flapack.dtrtri(ZZt)[0]))
-
-            err.append(la.norm(X.T - np.dot(W, Z)))
-            if i > 0 and np.abs(err[i] - err[i-1]) < 1e-6:
+            Minv = la.lapack.dtrtri(np.tril(np.dot(W.T,W).astype(np.float64)).T)[0].T
+            SW = np.zeros((n_features, n_components))
+            XWtXW = np.zeros((n_components, n_components))
+            sqX_i = 0.
+            for chunk in iter_chunks(X, chunk_size):
+                chunk = np.asarray(chunk, dtype=W.dtype) if mean is None else subtract_mean(chunk, mean, W.dtype)
+                XW = np.dot(chunk, W)
+                SW += np.dot(chunk.T, XW)
+                XWtXW += np.dot(XW.T, XW)
+                if sqX is None:
+                    sqX_i += sq_norm(chunk)
+            if sqX is None:
+                sqX = sqX_i
+            ZZt = np.dot(np.dot(Minv, XWtXW), Minv.T)
+            Wnew = np.dot(SW, np.dot(Minv.T, la.lapack.dtrtri(np.triu(ZZt))[0]))
+
+            # ||X^T - W Z||, with X Z^T = SW Minv^T
+            err2 = sqX - 2.*np.sum(Wnew*np.dot(SW, Minv.T)) + np.sum(np.dot(Wnew.T, Wnew)*ZZt)
+            err.append(np.sqrt(max(err2, 0.)))
+            W = Wnew.astype(W.dtype)
+            if verbose:
+                print("iteration %d: error %.6e" % (i, err[i]))
+            if i > 0 and np.abs(err[i] - err[i-1]) <= tol*err[i-1]:
                 break
 
+        if return_err:
+            return W, np.array(err)
         return W
 
 
-def ppca_minka(X,n_components):
-    pca = pca_model(X)
-    N,d = X.shape
-
-    pca_scores = []
-    for n in n_components:
-        evals=pca.evals
-
-        if n == d:
-            s2 = 1
-            pv = 0
-        else:
-            s2 = np.mean(evals[n:])
-            pv = -N*(d-n)/2.*np.log(s2)
-
-        pl = -N/2.*np.sum(np.log(evals[0:n]))
+# Summed squared projections of the rows of X (minus mean) onto each column of W, accumulated in float64
+def projected_sq_norms(X, W, mean=None, chunk_size=default_chunk_size):
+    sq = np.zeros(W.shape[1])
+    for chunk in iter_chunks(X, chunk_size):
+        chunk = np.asarray(chunk, dtype=W.dtype) if mean is None else subtract_mean(chunk, mean, W.dtype)
+        sq += np.sum(np.dot(chunk, W)**2, axis=0, dtype=np.float64)
+    return sq
 
-        m = d*n-n*(n+1.)/2.
-        pp = np.log(2.*np.pi)*(m+n+1.)/2.
 
-        evals_=evals.copy()
-        evals_[n:]=s2
-        pa=0.
-        for i in range(n):
-            for j in range(i+1, d):
-                pa += np.log(1./evals_[j]-1./evals_[i])+np.log(evals[i]-evals[j])+np.log(N)
-        pa=-pa/2.
+# Mean of the rows of X accumulated in float64 one chunk at a time
+def streaming_mean(X, chunk_size=default_chunk_size):
+    total = np.zeros(X.shape[1])
+    for chunk in iter_chunks(X, chunk_size):
+        total += np.sum(chunk, axis=0, dtype=np.float64)
+    return total/X.shape[0]
 
-        pu = -n*np.log(2.)
-        for i in range(1,n+1):
-            pu += special.gammaln((d-i+1)/2.)-np.log(np.pi)*(d-i+1)/2.
 
-        pca_scores.append(pu+pl+pv+pp+pa-n/2.*np.log(N))
-
-    return np.array(pca_scores)
+def ppca_minka(X,n_components):
+    pca = pca_model(X)
+    N,d = X.shape
+    return minka_evidence(pca.evals, N, d, n_components)
+
+
+# Laplace approximation to the PPCA evidence (Minka 2000) for every number of components in n_components.
+# The double sum over pairs (i<n, j>i) in the pa term is split into parts that are cumulative in n,
+# so all candidates are evaluated with O(d) work each after a single pass over the eigenvalue pairs.
+def minka_evidence(evals, N, d, n_components, block_size=256):
+    ns = np.atleast_1d(np.asarray(n_components, dtype=int))
+    L = evals.size
+    nmax = np.max(ns)
+    log_evals = np.log(evals)
+
+    # noise variance and the likelihood terms
+    tail = np.append(np.cumsum(evals[::-1])[::-1], 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s2 = np.where(ns == d, 1., tail[ns]/(L-ns))
+        pv = np.where(ns == d, 0., -N*(d-ns)/2.*np.log(s2))
+    pl = -N/2.*np.append(0., np.cumsum(log_evals))[ns]
+
+    m = d*ns-ns*(ns+1.)/2.
+    pp = np.log(2.*np.pi)*(m+ns+1.)/2.
+
+    # pairs with both eigenvalues kept: sum over i<j<n of log(1/evals[j]-1/evals[i])
+    # pairs with i<n: sum over j>i of log(evals[i]-evals[j])
+    inner = np.zeros(nmax+1)
+    rows = np.zeros(nmax+1)
+    for start in range(0, nmax, block_size):
+        stop = min(start+block_size, nmax)
+        idx = np.arange(start, stop)[:,np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pair = np.log(1./evals[start:stop,np.newaxis]-1./evals[np.newaxis,:nmax])
+            inner[start+1:stop+1] = np.sum(np.where(np.arange(nmax) < idx, pair, 0.), axis=1)
+            pair = np.log(evals[start:stop,np.newaxis]-evals[np.newaxis,:])
+            rows[start+1:stop+1] = np.sum(np.where(np.arange(L) > idx, pair, 0.), axis=1)
+    inner = np.cumsum(inner)
+    rows = np.cumsum(rows)
+
+    # pairs with i<n<=j, where the discarded eigenvalues are replaced by s2
+    outer = np.zeros(ns.size)
+    for k, n in enumerate(ns):
+        if L > n:
+            outer[k] = (L-n)*np.sum(np.log(1./s2[k]-1./evals[:n]))
+    n_pairs = ns*(L-1.)-ns*(ns-1.)/2.
+    pa = -(inner[ns]+rows[ns]+outer+n_pairs*np.log(N))/2.
+
+    i = np.arange(1, nmax+1)
+    pu = -ns*np.log(2.)+np.append(0., np.cumsum(special.gammaln((d-i+1)/2.)-np.log(np.pi)*(d-i+1)/2.))[ns]
+
+    return pu+pl+pv+pp+pa-ns/2.*np.log(N)
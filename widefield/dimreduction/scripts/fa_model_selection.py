@@ -1,7 +1,8 @@
-from sklearn.decomposition import FactorAnalysis
 import numpy as np
 import tables as tb
 
+from widefield.dimreduction.model_selection import fa_sweep
+
 # Import data
 basepath = "/suppscr/riekesheabrown/kpchamp/data/m187474/150804/"
 image_data_path = basepath + "data_detrend_mask.h5"
@@ -10,11 +11,11 @@ image_data_train = tb_open.root.data[:,20000:183000].T
 image_data_test = tb_open.root.data[:,183000:-20000].T
 tb_open.close()
 
-# Do model selection for Factor Analysis model
+# Do model selection for Factor Analysis model; each k is checkpointed in fa_sweep/ as soon as it is fit, so
+# rerunning after an interruption only fits the remaining k
 ll = np.load(basepath + 'fa_loglikelihoods.npy').tolist()
-for n_components in np.arange(2010,3001,10):
-    fa_model = FactorAnalysis(n_components=n_components+1)
-    fa_model.fit(image_data_train)
-    ll.append(fa_model.score(image_data_test))
+sweep = fa_sweep(image_data_train, image_data_test, np.arange(2010,3001,10)+1, basepath + 'fa_sweep/',
+                 n_jobs=4, blas_threads=4, dtype=np.float32)
+ll.extend(sweep['ll_test'])
 
 np.save(basepath + 'fa_loglikelihoods', np.array(ll))
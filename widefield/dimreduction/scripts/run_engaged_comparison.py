@@ -7,6 +7,7 @@ import pandas as pd
 import tables as tb
 
 from widefield.dimreduction.model_selection import pca_select
+from widefield.tools.chunk_tools import gather_rows
 
 mouseId = 'm177931'
 collectionDate = '150731'
@@ -15,7 +16,7 @@ datapath = basepath + mouseId + "/" + collectionDate + "/data_detrend_mask.h5"
 dfpath = basepath + "df_engaged_comparison.pkl"
 df = pd.read_pickle(dfpath)
 f = tb.open_file(datapath, 'r')
-X = f.root.data[:, :]
+X = f.root.data  # only the selected frames are read, see gather_rows
 
 de_idxs = pickle.load(open(basepath + mouseId + "/" + collectionDate + "/idxs.pkl", 'r'))
 num_disengaged = de_idxs[0].shape[0]
@@ -34,7 +35,7 @@ print >>open('output.txt','a'), "starting disengaged analysis"
 frames = de_idxs[0][0:n_samples]
 dfrow = {'mouseId': mouseId, 'date': collectionDate, 'sampleSize': n_samples, 'chunkNumber': 1,
          'engagement': 'D', 'frames': frames}
-dfrow['data'], evecs = pca_select(X[frames, :], ps, n_folds=n_folds)
+dfrow['data'], evecs = pca_select(gather_rows(X, frames), ps, n_folds=n_folds)
 pickle.dump(evecs, open(basepath + mouseId + "/" + collectionDate + "/evecs_de/" + "evecs_D.pkl", 'w'))
 df = df.append(dfrow, ignore_index=True)
 df.to_pickle(dfpath)
@@ -49,7 +50,7 @@ for idx in range(startIdxs.shape[0]):
     dfrow = {'mouseId': mouseId, 'date': collectionDate, 'sampleSize': n_samples, 'chunkNumber': idx + 1,
              'engagement': 'E', 'frames': frames}
 
-    dfrow['data'], evecs = pca_select(X[frames, :], ps, n_folds=n_folds)
+    dfrow['data'], evecs = pca_select(gather_rows(X, frames), ps, n_folds=n_folds)
 
     fout = "evecs_E_%d.pkl" % (idx + 1)
     pickle.dump(evecs, open(basepath + mouseId + "/" + collectionDate + "/evecs_de/" + fout, 'w'))
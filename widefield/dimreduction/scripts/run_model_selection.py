@@ -3,7 +3,7 @@ import pickle
 import numpy as np
 import pandas as pd
 import tables as tb
-from widefield.dimreduction.model_selection import pca_select
+from widefield.dimreduction.model_selection import pca_select_sweep
 
 mouseId = 'm187201'
 collectionDate = '150810'
@@ -13,7 +13,7 @@ dfpath = basepath + "allData_df_new.pkl"
 df = pd.read_pickle(dfpath)
 #df = pd.DataFrame()
 f=tb.open_file(datapath,'r')
-X=f.root.data[:,:]
+X=f.root.data  # frames are read from disk as they are sampled
 
 # note: total frames are 347973
 Tmax, n_features = f.root.data.shape
@@ -30,23 +30,18 @@ for idx in range(winDiv):
     n_folds = 4
     ps = np.concatenate(([1],np.arange(25,8200,25)))
 
-    for i_samples,n_samples in enumerate(samples):
+    # all sample sizes come from one permutation of the window, accumulated in a single pass
+    frames = np.arange(Twin)+Tstart
+    for n_samples, data, evecs in pca_select_sweep(X, samples, ps, n_folds=n_folds, frames=frames):
         dfrow = {'mouseId': mouseId, 'date': collectionDate, 'windowLength': Twin, 'startTime': Tstart,
                  'sampleSize': n_samples}
         print >>open('output.txt','a'), n_samples
-        if (n_samples % n_folds) != 0:
-            raise ValueError("number of samples n_samples=%d is not a multiple of n_folds=%d",n_samples,n_folds)
-
-        perm=np.random.choice(np.arange(Twin),n_samples,replace=False)+Tstart
-
-        fout="p_twin%d_nsamples%d_%d.pkl" % (Twin,n_samples,idx+1)
-        dfrow['data'],evecs = pca_select(X[perm,:], ps, n_folds=n_folds)
+        dfrow['data'] = data
 
         fout="evecs_twin%d_nsamples%d_tstart%d.pkl" % (Twin,n_samples,Tstart)
         pickle.dump(evecs, open(basepath + mouseId + "/" + collectionDate + "/evecs/" + fout,'w'))
 
         fout="p_twin%d_nsamples%d_%d.pkl" % (Twin,n_samples,idx+1)
-        dfrow['data']['perm'] = perm
         pickle.dump(dfrow['data'], open(fout,'w'))
         df = df.append(dfrow, ignore_index=True)
         df.to_pickle(dfpath)
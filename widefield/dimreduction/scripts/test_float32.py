@@ -0,0 +1,70 @@
+import numpy as np
+
+from widefield.dimreduction.pca import pca_model, ppca_model, pcaEM
+from widefield.dimreduction.nmf import NMF
+
+# float32 fits compared with float64 fits of the same data. Data and factors are kept in float32 while
+# means, evals and log likelihoods are accumulated in float64 (see pca.working_dtype), so the results should
+# agree to the tolerances below. Synthetic movie: 10 components with a 20x range of scales plus noise.
+rng = np.random.RandomState(0)
+n_samples, n_features, n_latent = 4000, 300, 10
+scales = np.logspace(1.3, 0, n_latent)
+W_true = np.linalg.qr(rng.randn(n_features, n_latent))[0]*scales
+X64 = np.dot(rng.randn(n_samples, n_latent), W_true.T) + 0.5*rng.randn(n_samples, n_features) + 3.
+X32 = X64.astype(np.float32)
+Xtest64 = np.dot(rng.randn(1000, n_latent), W_true.T) + 0.5*rng.randn(1000, n_features) + 3.
+Xtest32 = Xtest64.astype(np.float32)
+ps = np.arange(1, 31)
+
+
+def rel_err(a, b):
+    return np.max(np.abs(np.asarray(a, dtype=np.float64) - b)/np.abs(b))
+
+
+# sine of the largest principal angle between the column spans of A and B (arccos of the smallest cosine, as
+# in subspace_angle, cannot resolve angles much below 1e-4 in double precision)
+def subspace_sin(A, B):
+    A = np.linalg.qr(np.asarray(A, dtype=np.float64))[0]
+    B = np.linalg.qr(np.asarray(B, dtype=np.float64))[0]
+    return np.linalg.norm(B - np.dot(A, np.dot(A.T, B)), 2)
+
+
+def check(name, err, tol):
+    print("%s: %.2e (tolerance %.0e)" % (name, err, tol))
+    assert err < tol
+
+
+# pca_model evals, from the SVD and from the streamed covariance
+for fitWith in ['SVD', 'covariance']:
+    pca64 = pca_model(X64, n_components=n_latent, fitWith=fitWith)
+    pca32 = pca_model(X32, n_components=n_latent, fitWith=fitWith)
+    check("pca_model %s evals" % fitWith, rel_err(pca32.evals[:n_latent], pca64.evals[:n_latent]), 1e-5)
+    check("pca_model %s subspace sine" % fitWith, subspace_sin(pca32.components, pca64.components), 1e-4)
+
+# ppca_model evals, training and held-out log likelihoods
+ppca64 = ppca_model(X64, n_components=n_latent)
+ppca32 = ppca_model(X32, n_components=n_latent)
+check("ppca_model evals", rel_err(ppca32.evals[:n_latent], ppca64.evals[:n_latent]), 1e-5)
+check("ppca_model LLtrain", rel_err(ppca32.LLtrain, ppca64.LLtrain), 1e-5)
+check("ppca_model held-out logLikelihoods",
+      rel_err(ppca32.logLikelihoods(Xtest32, ps), ppca64.logLikelihoods(Xtest64, ps)), 1e-5)
+
+# pcaEM from the same initial W
+W_init = rng.randn(n_features, n_latent)
+mean = np.mean(X64, axis=0)
+W64, err64 = pcaEM(X64, n_latent, 20, W_init=W_init, mean=mean, tol=-1, return_err=True)
+W32, err32 = pcaEM(X32, n_latent, 20, W_init=W_init, mean=mean, tol=-1, return_err=True)
+check("pcaEM subspace sine", subspace_sin(W32, W64), 1e-4)
+check("pcaEM final reconstruction error", rel_err(err32[-1], err64[-1]), 1e-5)
+
+# NMF from the same initial factors
+Xnn64 = np.abs(X64)
+Xnn32 = Xnn64.astype(np.float32)
+nmf64 = NMF(n_components=n_latent)
+W0, H0 = nmf64.initialize_nmf(Xnn64, n_latent)
+Z64 = nmf64.fit(Xnn64, max_iter=50, tol=0, W=W0, H=H0)
+nmf32 = NMF(n_components=n_latent)
+Z32 = nmf32.fit(Xnn32, max_iter=50, tol=0, W=W0, H=H0)
+resid64 = np.linalg.norm(Xnn64 - nmf64.reconstruct(Xnn64, Z64))/np.linalg.norm(Xnn64)
+resid32 = np.linalg.norm(Xnn64 - nmf32.reconstruct(Xnn32, Z32))/np.linalg.norm(Xnn64)
+check("NMF relative reconstruction error", abs(resid32 - resid64)/resid64, 1e-4)
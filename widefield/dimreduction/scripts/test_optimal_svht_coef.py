@@ -0,0 +1,32 @@
+from __future__ import division
+import numpy as np
+
+from widefield.dimreduction.optimal_svht_coef import optimal_svht_coef, optimal_svht_coef_sigma_known, \
+    medianMarcenkoPastur, table_betas
+
+# Accuracy of the interpolated Marcenko-Pastur median table used by optimal_svht_coef(beta, False). The grid
+# covers the table nodes, the midpoints between them (where the interpolation error is largest), beta below the
+# table and beta > 1 (the transposed aspect ratio).
+betas = np.concatenate((table_betas, (table_betas[:-1] + table_betas[1:])/2., [0.0002, 0.0005, 2., 10., 500.]))
+
+coef_table = optimal_svht_coef(betas, False)
+coef_exact = optimal_svht_coef(betas, False, exact=True)
+table_err = np.max(np.abs(coef_table - coef_exact)/coef_exact)
+print("table vs exact: max relative error %.2e" % table_err)
+assert table_err < 2e-7
+
+# scalar beta returns a scalar matching the array result
+assert np.ndim(optimal_svht_coef(0.25, False)) == 0
+assert np.allclose(optimal_svht_coef(0.25, False), optimal_svht_coef(np.array([0.25]), False))
+
+# the original bisection brackets the median to within 1e-3, so its coefficient agrees with the exact one to
+# about half of that relative to the median
+check_betas = np.linspace(0.01, 1., 12)
+median_bisection = np.array([medianMarcenkoPastur(b) for b in check_betas])
+coef_bisection = optimal_svht_coef_sigma_known(check_betas)/np.sqrt(median_bisection)
+coef_exact = optimal_svht_coef(check_betas, False, exact=True)
+median_exact = (optimal_svht_coef_sigma_known(check_betas)/coef_exact)**2
+print("bisection vs exact: max median error %.2e, max relative coefficient error %.2e" %
+      (np.max(np.abs(median_bisection - median_exact)), np.max(np.abs(coef_bisection - coef_exact)/coef_exact)))
+assert np.all(np.abs(median_bisection - median_exact) <= 5e-4)
+assert np.all(np.abs(coef_bisection - coef_exact)/coef_exact <= 5e-4/median_exact)
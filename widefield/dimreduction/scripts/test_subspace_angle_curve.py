@@ -0,0 +1,36 @@
+import numpy as np
+
+from widefield.dimreduction.analyze_components import subspace_angle, subspace_angle_curve
+
+# subspace_angle_curve against subspace_angle on every prefix, for the bases that come up when comparing evecs
+# across windows or sessions: reordered (permuted) and sign-flipped copies of the same basis, nested bases and
+# unrelated random bases.
+n_pixels, n_components = 500, 60
+
+
+def orth(X):
+    return np.linalg.qr(X)[0]
+
+
+def prefix_angles(A, B, cutoff):
+    return np.array([subspace_angle(A[:,0:k], B[:,0:k]) for k in range(1, cutoff+1)])
+
+
+def check(name, A, B, cutoff=n_components, tol=1e-6):
+    err = np.max(np.abs(subspace_angle_curve(A, B, cutoff) - prefix_angles(A, B, cutoff)))
+    print("%s: max error %.2e" % (name, err))
+    assert err < tol
+
+
+A = orth(np.random.RandomState(2).randn(n_pixels, n_components))
+check("permuted", A, A[:, np.random.RandomState(6).permutation(n_components)])
+for seed in range(20):
+    rng = np.random.RandomState(seed)
+    A = orth(rng.randn(n_pixels, n_components))
+    check("permuted %d" % seed, A, A[:, rng.permutation(n_components)])
+    check("permuted, sign flipped %d" % seed, A, A[:, rng.permutation(n_components)]*rng.choice([-1, 1], n_components))
+    # B spans the first n_components + 10 columns of a larger basis, so span(A) is inside span(B)
+    Abig = orth(rng.randn(n_pixels, n_components + 10))
+    check("nested %d" % seed, Abig[:, 0:n_components],
+          orth(np.dot(Abig, rng.randn(n_components + 10, n_components + 10))), n_components)
+    check("random %d" % seed, A, orth(rng.randn(n_pixels, n_components)))
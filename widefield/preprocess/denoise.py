@@ -0,0 +1,114 @@
+from __future__ import division
+
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.linalg as la
+
+from widefield.dimreduction.optimal_svht_coef import optimal_svht_coef
+from widefield.tools.chunk_tools import chunk_size as default_chunk_size
+
+
+# Local low-rank denoising of a frames x pixels movie X (array, memmap or PyTables array, e.g. the detrended
+# data), where column j of X is pixel pushmask[j] of a frame_shape image (see movie_mask.mask_to_index; all
+# pixels if pushmask is None). The frame is covered by overlapping square patches of patch_size pixels that
+# overlap by overlap pixels. For every block of chunk_size frames, the block of each patch is centered, its
+# SVD is truncated at the optimal hard threshold for unknown noise level (Gavish & Donoho 2014, as for
+# p_threshold in pca_select) and the reconstructions are blended with weights that taper linearly across the
+# overlaps. Patches are processed in a pool of n_threads threads and every block is written to out (e.g. a
+# PyTables array or memmap of X.shape) before the next one is read. Returns out and the rank kept for every
+# block and patch.
+def svht_denoise(X, frame_shape, pushmask=None, out=None, patch_size=32, overlap=8, n_threads=4,
+                 chunk_size=default_chunk_size):
+    n_frames, n_pixels = X.shape
+    if not 0 <= overlap < patch_size:
+        raise ValueError("overlap=%r must be in [0, patch_size=%d)" % (overlap, patch_size))
+    if out is None:
+        out = np.empty(X.shape, dtype=X.dtype if np.issubdtype(X.dtype, np.floating) else np.float64)
+    patches, weights = get_patches(frame_shape, pushmask, patch_size, overlap)
+    if pushmask is None and n_pixels != frame_shape[0]*frame_shape[1]:
+        raise ValueError("X has %d pixels, frame_shape %r has %d" % (n_pixels, frame_shape,
+                                                                     frame_shape[0]*frame_shape[1]))
+
+    # total blending weight of every pixel
+    weight_sum = np.zeros(n_pixels)
+    for cols, w in zip(patches, weights):
+        weight_sum[cols] += w
+
+    ranks = np.zeros(((n_frames + chunk_size - 1)//chunk_size, len(patches)), dtype=int)
+    pool = ThreadPool(n_threads) if n_threads > 1 else None
+    try:
+        for i_chunk, start in enumerate(range(0, n_frames, chunk_size)):
+            stop = min(start + chunk_size, n_frames)
+            block = np.asarray(X[start:stop], dtype=np.float64)
+
+            def denoise_patch(i):
+                return svht_reconstruct(block[:, patches[i]])
+
+            if pool is None:
+                results = [denoise_patch(i) for i in range(len(patches))]
+            else:
+                results = pool.map(denoise_patch, range(len(patches)))
+
+            denoised = np.zeros(block.shape)
+            for i, (recon, rank) in enumerate(results):
+                denoised[:, patches[i]] += recon*weights[i]
+                ranks[i_chunk, i] = rank
+            out[start:stop] = denoised/weight_sum
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return out, ranks
+
+
+# Reconstruction of the samples x features block X from its singular values above the optimal hard threshold
+# tau = omega(beta)*median(s), and the number of singular values kept
+def svht_reconstruct(X):
+    mean = np.mean(X, axis=0)
+    U, s, Vt = la.svd(X - mean, full_matrices=False, check_finite=False)
+    beta = min(X.shape)/max(X.shape)
+    tau = optimal_svht_coef(beta, False)*np.median(s)
+    rank = int(np.sum(s > tau))
+    return np.dot(U[:, :rank]*s[:rank], Vt[:rank]) + mean, rank
+
+
+# Columns of the masked movie in each overlapping patch of the frame, and the blending weight of each of those
+# columns. Patches with no pixels in the mask are dropped.
+def get_patches(frame_shape, pushmask=None, patch_size=32, overlap=8):
+    ny, nx = frame_shape
+    columns = -np.ones(ny*nx, dtype=int)
+    if pushmask is None:
+        columns[:] = np.arange(ny*nx)
+    else:
+        columns[pushmask] = np.arange(len(pushmask))
+    columns = columns.reshape((ny, nx))
+
+    patches = []
+    weights = []
+    for y0 in patch_starts(ny, patch_size, patch_size - overlap):
+        wy = taper(min(patch_size, ny), overlap)
+        for x0 in patch_starts(nx, patch_size, patch_size - overlap):
+            wx = taper(min(patch_size, nx), overlap)
+            cols = columns[y0:y0 + patch_size, x0:x0 + patch_size].ravel()
+            w = np.outer(wy, wx).ravel()
+            inmask = cols >= 0
+            if np.any(inmask):
+                patches.append(cols[inmask])
+                weights.append(w[inmask])
+    return patches, weights
+
+
+# start positions of windows of size covering range(n) with the given stride, the last window ending at n
+def patch_starts(n, size, stride):
+    if n <= size:
+        return [0]
+    starts = list(range(0, n - size, stride))
+    starts.append(n - size)
+    return starts
+
+
+# weights of a window of length n rising linearly over the first and last overlap positions
+def taper(n, overlap):
+    i = np.arange(n)
+    return np.minimum(1., np.minimum(i + 1, n - i)/(overlap + 1.))
@@ -1,3 +1,5 @@
+from functools import reduce
+
 import numpy as np
 
 
@@ -60,3 +62,41 @@ def unmask_to_movie(mov_detrend,pushmask,npxls1,npxls2):
     else:
         frames = mov_detrend.shape[1]
         return unmask(mov_detrend,pushmask,npxls1*npxls2).reshape((npxls1,npxls2,frames))
+
+
+# Common pixel space for sessions with different pushmasks (all from frames of the same size): the pixels in
+# every mask ('intersection') or in any mask ('union'). Returns the common pushmask and one pixel map per
+# session, (dest, src) index arrays such that column src[i] of the session's masked data is column dest[i]
+# of the common space. The maps are computed once from the sorted pushmasks, without unmasking to full frames.
+def common_pixel_map(pushmasks, mode='intersection'):
+    if mode == 'intersection':
+        common = reduce(np.intersect1d, pushmasks)
+    elif mode == 'union':
+        common = reduce(np.union1d, pushmasks)
+    else:
+        raise ValueError("mode=%r must be 'intersection' or 'union'" % mode)
+
+    pixel_maps = []
+    for pushmask in pushmasks:
+        pushmask = np.asarray(pushmask)
+        idx = np.searchsorted(pushmask, common)
+        present = idx < pushmask.size
+        present[present] = pushmask[idx[present]] == common[present]
+        pixel_maps.append((np.flatnonzero(present), idx[present]))
+    return common, pixel_maps
+
+
+# Moves the masked pixels of X (axis 0 for pixels x components bases, axis 1 for frames x pixels movies or
+# chunks of them) to the common space of n_common pixels given a pixel map from common_pixel_map. Common pixels
+# the session does not have are set to fill.
+def remap_pixels(X, pixel_map, n_common, axis=0, fill=0.):
+    dest, src = pixel_map
+    shape = list(X.shape)
+    shape[axis] = n_common
+    dtype = np.result_type(X.dtype, np.min_scalar_type(fill))
+    out = np.full(shape, fill, dtype=dtype)
+    if axis == 0:
+        out[dest] = X[src]
+    else:
+        out[:, dest] = X[:, src]
+    return out
@@ -0,0 +1,72 @@
+# Tools for streaming over the rows (frames) of data that may not fit in memory:
+# numpy arrays, memmaps and PyTables arrays are all handled the same way.
+
+import numpy as np
+
+# number of rows read at a time when streaming
+chunk_size = 4096
+
+
+# yields consecutive blocks of rows start:stop of X
+def iter_chunks(X, chunk_size=chunk_size, start=0, stop=None):
+    if stop is None:
+        stop = X.shape[0]
+    for i in range(start, stop, chunk_size):
+        yield X[i:min(i + chunk_size, stop)]
+
+
+# Reads rows idxs of X (any order, repeats allowed) into out in the requested order. The indices are sorted and
+# grouped by storage chunk (the dataset chunkshape for PyTables arrays, chunk_rows rows otherwise) so that each
+# chunk is read once, with a single contiguous slice.
+def gather_rows(X, idxs, out=None, chunk_rows=None):
+    n_rows = X.shape[0]
+    idxs = np.asarray(idxs, dtype=np.int64)
+    if idxs.size and (idxs.min() < 0 or idxs.max() >= n_rows):
+        raise IndexError("row indices must be in [0, %d)" % n_rows)
+    if chunk_rows is None:
+        chunkshape = getattr(X, 'chunkshape', None)
+        chunk_rows = chunkshape[0] if chunkshape is not None else chunk_size
+    if out is None:
+        out = np.empty((idxs.size,) + tuple(X.shape[1:]), dtype=X.dtype)
+
+    order = np.argsort(idxs, kind='mergesort')
+    sorted_idxs = idxs[order]
+    chunk_ids = sorted_idxs // chunk_rows
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(chunk_ids)) + 1))
+    stops = np.append(starts[1:], idxs.size)
+
+    for i in range(starts.size if idxs.size else 0):
+        rows = sorted_idxs[starts[i]:stops[i]]
+        block = X[rows[0]:rows[-1]+1]
+        out[order[starts[i]:stops[i]]] = block[rows - rows[0]]
+    return out
+
+
+# Applies func to consecutive chunks of rows of X and writes the results (n_cols columns) into the matching rows
+# of out. X may be an array, memmap or PyTables array, or any iterable of row chunks; out may be anything that
+# supports slice assignment (e.g. a memmap). A new array is returned when out is None.
+def map_chunks(X, func, n_cols, dtype, out=None, chunk_size=chunk_size):
+    if getattr(X, 'ndim', 2) == 1:
+        # a single row
+        if out is None:
+            return func(X)
+        out[:] = func(X)
+        return out
+    if hasattr(X, 'shape'):
+        if out is None:
+            out = np.empty((X.shape[0], n_cols), dtype=dtype)
+        chunks = iter_chunks(X, chunk_size)
+    else:
+        chunks = X
+    if out is None:
+        results = [func(chunk) for chunk in chunks]
+        return np.concatenate(results) if results else np.empty((0, n_cols), dtype=dtype)
+
+    start = 0
+    for chunk in chunks:
+        result = func(chunk)
+        out[start:start + result.shape[0]] = result
+        start += result.shape[0]
+    if start != out.shape[0]:
+        raise ValueError("%d rows written to out with %d rows" % (start, out.shape[0]))
+    return out
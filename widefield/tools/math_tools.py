@@ -1,5 +1,46 @@
 import numpy as np
 
+# default memory bound (in bytes) for the input and output of a single block of trials
+block_bytes = 2**28
 
-def broadcast_left_matrix_multiply(A,X):
-    return np.transpose(np.dot(np.transpose(X,(0,2,1)),A.T),(0,2,1))
\ No newline at end of file
+
+def broadcast_left_matrix_multiply(A, X, out=None, max_block_bytes=block_bytes):
+    # computes A*X[i] for every X[i] in the 3-d array X (e.g. trials x features x time)
+    n_trials, n_rows, n_cols = X.shape
+    if A.shape[1] != n_rows:
+        raise ValueError("A.shape[1]=%d not equal to X.shape[1]=%d" % (A.shape[1], n_rows))
+    return blocked_matmul(A, X, (n_trials, A.shape[0], n_cols), out, max_block_bytes, left=True)
+
+
+def batched_projection(X, W, out=None, max_block_bytes=block_bytes):
+    # computes X[i]*W for every X[i] in the 3-d array X, e.g. projecting trials x time x features
+    # data onto a features x components basis (PCA evecs, NMF components)
+    n_trials, n_samples, n_features = X.shape
+    if W.shape[0] != n_features:
+        raise ValueError("W.shape[0]=%d not equal to n_features=%d" % (W.shape[0], n_features))
+    return blocked_matmul(W, X, (n_trials, n_samples, W.shape[1]), out, max_block_bytes, left=False)
+
+
+def blocked_matmul(A, X, out_shape, out=None, max_block_bytes=block_bytes, left=True):
+    # X (and out) may be memmaps or PyTables arrays; only one contiguous block of trials is in memory at a time
+    dtype = np.result_type(A.dtype, X.dtype)
+    if out is None:
+        out = np.empty(out_shape, dtype=dtype)
+    elif tuple(out.shape) != tuple(out_shape):
+        raise ValueError("out.shape=%r not equal to expected shape %r" % (tuple(out.shape), tuple(out_shape)))
+
+    # number of trials per block such that the input and output blocks fit in max_block_bytes
+    trial_bytes = (np.prod(X.shape[1:]) + np.prod(out_shape[1:]))*dtype.itemsize
+    block_size = int(max(1, max_block_bytes//trial_bytes))
+
+    # write straight into out when the result can be stored there without a cast
+    direct = isinstance(out, np.ndarray) and out.dtype == dtype and out.flags.c_contiguous
+    for start in range(0, out_shape[0], block_size):
+        stop = min(start + block_size, out_shape[0])
+        Xb = np.ascontiguousarray(X[start:stop], dtype=dtype)
+        operands = (A, Xb) if left else (Xb, A)
+        if direct:
+            np.matmul(operands[0], operands[1], out=out[start:stop])
+        else:
+            out[start:stop] = np.matmul(operands[0], operands[1])
+    return out